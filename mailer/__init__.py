@@ -17,16 +17,67 @@ def get_priority(priority):
     return priority
 
 
-def _add_attachments(msg, attachments=None):
-    from mailer.models import Attachment
-
-    if attachments:
-        for attachment in attachments:
-            filename, content, mimetype = attachment
-            Attachment.objects.from_content(msg, filename, content, mimetype)
-
-    msg.ready_to_send = True
-    msg.save()
+def enqueue_messages(messages, attachments=None):
+    """
+    Put the given unsaved Message instances on the queue, ready to be sent.
+
+    Messages are inserted with bulk_create in chunks of
+    MAILER_ENQUEUE_BATCH_SIZE inside one transaction, after the unsaved
+    MessageContent they share. Each of the
+    (filename, content, mimetype) ``attachments`` is stored once and shared
+    by all the messages; the content may be a file-like object or a path,
+    which is stored in chunks.
+    With MAILER_PRERENDER, the encoded message is stored as well. Waiting
+    send loops are notified when the transaction commits.
+    """
+    from functools import partial
+
+    from django.db import connections, router, transaction
+    from mailer.engine import prerender
+    from mailer.notify import notify
+    from mailer.models import Attachment, Blob, Message
+    from mailer.settings import MAILER_ENQUEUE_BATCH_SIZE, MAILER_PRERENDER
+
+    db = router.db_for_write(Message)
+    features = connections[db].features
+    can_bulk_insert = not attachments or getattr(
+        features,
+        "can_return_rows_from_bulk_insert",
+        getattr(features, "can_return_ids_from_bulk_insert", False),
+    )
+
+    with transaction.atomic(using=db):
+        for msg in messages:
+            msg.ready_to_send = True
+            if msg.content is not None:
+                if msg.content.pk is None:
+                    msg.content.save(using=db)
+                # Set the key of content saved after the message was created
+                msg.content = msg.content
+        if attachments:
+            # Stored first, so files are read only once
+            attachments = [
+                (filename, Blob.objects.from_content(content), mimetype)
+                for filename, content, mimetype in attachments
+            ]
+        if MAILER_PRERENDER:
+            prerender(messages, attachments)
+        if can_bulk_insert:
+            Message.objects.bulk_create(messages, MAILER_ENQUEUE_BATCH_SIZE)
+        else:
+            # Attachments need the primary keys, which this database doesn't
+            # return from a bulk insert
+            for msg in messages:
+                msg.save()
+
+        if attachments:
+            Attachment.objects.bulk_attach(
+                messages, attachments, MAILER_ENQUEUE_BATCH_SIZE
+            )
+        if messages:
+            # Wake up the send loop once the messages are visible to it
+            transaction.on_commit(partial(notify, db), using=db)
+    return messages
 
 
 def send_mail(
@@ -46,15 +97,24 @@ def send_mail(
     See the documentation for django.core.mail.send_mail for more information
     on the basic options.
 
+    Recipients may be (address, context) tuples instead of addresses, the
+    context being a dict of variables substituted for ``$name`` in the
+    subject and bodies when the message is sent. The content of mail to
+    several recipients is stored once, shared by all of their messages.
+
     You can add attachments by passing a list of tuples to the attachments
     keyword argument. The tuples must have the following structure:
     (filename, bytes, mimetype or None)
     e.g.
     ('filename.txt', 'raw bytestring', 'application/octet-stream')
+    Instead of bytes, an open file or a pathlib.Path can be given, which is
+    stored without reading it into memory.
     """
+    import json
+
     from django.conf import settings
     from django.utils.encoding import force_str
-    from mailer.models import Message
+    from mailer.models import Message, MessageContent
 
     # need to do this in case subject used lazy version of ugettext
     subject = force_str(subject)
@@ -64,18 +124,31 @@ def send_mail(
     if from_email is None:
         from_email = settings.DEFAULT_FROM_EMAIL
 
-    for to_address in recipient_list:
-        msg = Message(
-            to_address=to_address,
-            from_address=from_email,
-            subject=subject,
-            message_body=message,
-            html_body=html_body,
-            priority=priority,
-            ready_to_send=False,
+    recipients = [
+        recipient if isinstance(recipient, (list, tuple)) else (recipient, None)
+        for recipient in recipient_list
+    ]
+    if len(recipients) > 1 or any(context for _, context in recipients):
+        content = MessageContent(
+            subject=subject, message_body=message, html_body=html_body
         )
-        msg.save()
-        _add_attachments(msg, attachments)
+        fields = dict(content=content)
+    else:
+        fields = dict(subject=subject, message_body=message, html_body=html_body)
+
+    enqueue_messages(
+        [
+            Message(
+                to_address=to_address,
+                from_address=from_email,
+                priority=priority,
+                context=json.dumps(context) if context else "",
+                **fields
+            )
+            for to_address, context in recipients
+        ],
+        attachments,
+    )
 
 
 def mail_admins(
@@ -86,17 +159,19 @@ def mail_admins(
     from mailer.models import Message
 
     priority = get_priority(priority)
-    for name, to_address in settings.ADMINS:
-        msg = Message(
-            to_address=to_address,
-            from_address=settings.SERVER_EMAIL,
-            subject=settings.EMAIL_SUBJECT_PREFIX + force_str(subject),
-            message_body=force_str(message),
-            priority=priority,
-            ready_to_send=False,
-        )
-        msg.save()
-        _add_attachments(msg, attachments)
+    enqueue_messages(
+        [
+            Message(
+                to_address=to_address,
+                from_address=settings.SERVER_EMAIL,
+                subject=settings.EMAIL_SUBJECT_PREFIX + force_str(subject),
+                message_body=force_str(message),
+                priority=priority,
+            )
+            for name, to_address in settings.ADMINS
+        ],
+        attachments,
+    )
 
 
 def mail_managers(
@@ -107,14 +182,16 @@ def mail_managers(
     from mailer.models import Message
 
     priority = get_priority(priority)
-    for name, to_address in settings.MANAGERS:
-        msg = Message(
-            to_address=to_address,
-            from_address=settings.SERVER_EMAIL,
-            subject=settings.EMAIL_SUBJECT_PREFIX + force_str(subject),
-            message_body=force_str(message),
-            priority=priority,
-            ready_to_send=False,
-        )
-        msg.save()
-        _add_attachments(msg, attachments)
+    enqueue_messages(
+        [
+            Message(
+                to_address=to_address,
+                from_address=settings.SERVER_EMAIL,
+                subject=settings.EMAIL_SUBJECT_PREFIX + force_str(subject),
+                message_body=force_str(message),
+                priority=priority,
+            )
+            for name, to_address in settings.MANAGERS
+        ],
+        attachments,
+    )
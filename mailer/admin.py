@@ -1,15 +1,34 @@
 from django.contrib import admin
-from mailer.models import Message, DontSendEntry, MessageLog, Attachment
+from mailer.models import (
+    Message,
+    MessageContent,
+    DontSendEntry,
+    MessageLog,
+    Attachment,
+    Blob,
+)
 
 
 class AttachmentInlineAdmin(admin.TabularInline):
     model = Attachment
     extra = 0
+    raw_id_fields = ("blob",)
 
 
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ("id", "to_address", "subject", "when_added", "priority")
+    list_display = ("id", "to_address", "message_subject", "when_added", "priority")
+    list_select_related = ("content",)
     inlines = (AttachmentInlineAdmin,)
+    raw_id_fields = ("content",)
+
+    def message_subject(self, message):
+        return message.get_subject()
+
+    message_subject.short_description = "subject"
+
+
+class MessageContentAdmin(admin.ModelAdmin):
+    list_display = ("id", "subject", "created")
 
 
 class DontSendEntryAdmin(admin.ModelAdmin):
@@ -22,11 +41,17 @@ class MessageLogAdmin(admin.ModelAdmin):
 
 
 class AttachmentAdmin(admin.ModelAdmin):
-    list_display = ("message", "attachment_file")
-    raw_id_fields = ("message",)
+    list_display = ("message", "filename", "blob", "attachment_file")
+    raw_id_fields = ("message", "blob")
+
+
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ("sha256", "size", "last_used")
 
 
 admin.site.register(Message, MessageAdmin)
+admin.site.register(MessageContent, MessageContentAdmin)
 admin.site.register(DontSendEntry, DontSendEntryAdmin)
 admin.site.register(MessageLog, MessageLogAdmin)
 admin.site.register(Attachment, AttachmentAdmin)
+admin.site.register(Blob, BlobAdmin)
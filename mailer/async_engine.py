@@ -0,0 +1,204 @@
+"""
+Alternative delivery engine draining the queue on an asyncio event loop.
+
+Messages are read, logged and removed from the queue exactly like in
+``mailer.engine``, but delivery talks SMTP directly with ``aiosmtplib``, using
+the relays of ``mailer.engine.get_relays()`` or the
+``EMAIL_HOST``/``EMAIL_PORT``/... settings rather than ``EMAIL_BACKEND``.
+Database access never happens while the event loop runs.
+"""
+import asyncio
+import time
+
+from logging import getLogger
+from socket import error as socket_error
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.message import sanitize_address
+
+from mailer import engine, metrics
+from mailer.connection import weighted_order
+from mailer.streaming import streamed_parts
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+
+logger = getLogger(__name__)
+
+# Number of SMTP connections delivering messages at the same time
+CONNECTIONS = getattr(settings, "MAILER_ASYNC_CONNECTIONS", 10)
+
+
+def send_all(limit=None, use_locking=True, worker=False, concurrency=None):
+    """
+    Send all eligible messages in the queue over ``concurrency`` SMTP
+    connections driven by one event loop.
+    """
+    engine.run_pass(
+        send_messages_queued, limit, use_locking, worker, concurrency=concurrency
+    )
+
+
+def send_messages_queued(limit, worker_id=None, concurrency=None):
+    if aiosmtplib is None:
+        raise ImproperlyConfigured("The async mailer engine requires aiosmtplib.")
+
+    batches = engine.queue_batches(worker_id)
+    loop = asyncio.new_event_loop()
+    sender = AsyncSender(loop, concurrency or CONNECTIONS, engine.get_relays())
+    try:
+        total = engine.process_batches(batches, limit, sender.deliver, worker_id)
+    finally:
+        batches.close()
+        loop.run_until_complete(sender.close())
+        loop.close()
+    logger.info(
+        "%s message(s) processed using %s connection(s)." % (total, sender.opened)
+    )
+    return total
+
+
+class AsyncSender(object):
+    """
+    Deliver the emails of a batch over up to ``size`` SMTP connections, which
+    stay open between batches. With ``relays``, each connection is made to
+    one of them, picked by weight among the healthy ones.
+    """
+
+    def __init__(self, loop, size, relays=None):
+        self.loop = loop
+        self.relays = relays or []
+        self.clients = [None] * size
+        self.slot_relays = [None] * size
+        self.opened = 0
+
+    def deliver(self, emails, deadline=None):
+        return self.loop.run_until_complete(self._deliver(emails, deadline))
+
+    async def _deliver(self, emails, deadline=None):
+        # Emails not started before the deadline, or once stopping, are left
+        # None
+        results = [None] * len(emails)
+        pending = iter(enumerate(emails))
+
+        async def work(slot):
+            for index, email in pending:
+                if engine.stopping.is_set():
+                    return
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                results[index] = await self._send(slot, email)
+
+        slots = range(min(len(self.clients), len(emails)))
+        await asyncio.gather(*[work(slot) for slot in slots])
+        return results
+
+    async def _send(self, slot, email):
+        try:
+            try:
+                return await self._sendmail(slot, email)
+            except aiosmtplib.SMTPServerDisconnected:
+                await self._disconnect(slot)
+                return await self._sendmail(slot, email)
+        except (
+            socket_error,
+            aiosmtplib.SMTPServerDisconnected,
+            aiosmtplib.SMTPTimeoutError,
+        ) as err:
+            # The connection can't be trusted anymore, the next one may be
+            # made to another relay
+            if self.slot_relays[slot] is not None:
+                self.slot_relays[slot].failed()
+            await self._disconnect(slot)
+            return err
+        except (UnicodeEncodeError, aiosmtplib.SMTPException) as err:
+            return err
+        except Exception as err:
+            # Never lose the outcome of the emails already sent in the batch
+            logger.exception("Sending the message failed.")
+            await self._disconnect(slot)
+            return err
+
+    async def _sendmail(self, slot, email):
+        client = await self._connect(slot)
+        encoding = email.encoding or settings.DEFAULT_CHARSET
+        addresses = dict(
+            (sanitize_address(address, encoding), address)
+            for address in email.recipients()
+        )
+        # aiosmtplib needs the whole message
+        for part in streamed_parts(email):
+            part.load()
+        with metrics.timer("smtp_send"):
+            refused, _ = await client.sendmail(
+                sanitize_address(email.from_email, encoding),
+                list(addresses),
+                email.message().as_bytes(linesep="\r\n"),
+            )
+        # Refused recipients as smtplib reports them
+        return dict(
+            (addresses.get(address, address), tuple(response))
+            for address, response in refused.items()
+        )
+
+    async def _connect(self, slot):
+        if self.clients[slot] is None:
+            options = {
+                "host": settings.EMAIL_HOST,
+                "port": settings.EMAIL_PORT,
+                "username": settings.EMAIL_HOST_USER,
+                "password": settings.EMAIL_HOST_PASSWORD,
+                "use_ssl": settings.EMAIL_USE_SSL,
+                "use_tls": settings.EMAIL_USE_TLS,
+                "timeout": settings.EMAIL_TIMEOUT,
+            }
+            relay = self._relay()
+            if relay is not None:
+                options.update(relay.options)
+            client = aiosmtplib.SMTP(
+                hostname=options["host"],
+                port=options["port"],
+                username=options["username"] or None,
+                password=options["password"] or None,
+                use_tls=options["use_ssl"],
+                start_tls=options["use_tls"],
+                timeout=options["timeout"],
+            )
+            try:
+                with metrics.timer("smtp_connect"):
+                    await client.connect()
+            except (socket_error, aiosmtplib.SMTPException):
+                if relay is not None:
+                    relay.failed()
+                raise
+            if relay is not None:
+                relay.succeeded()
+            self.clients[slot] = client
+            self.slot_relays[slot] = relay
+            self.opened += 1
+        return self.clients[slot]
+
+    def _relay(self):
+        for relay in weighted_order(self.relays):
+            if relay.available():
+                return relay
+        if self.relays:
+            raise aiosmtplib.SMTPConnectError("No relay available")
+        return None
+
+    async def _disconnect(self, slot):
+        client, self.clients[slot] = self.clients[slot], None
+        self.slot_relays[slot] = None
+        if client is not None and client.is_connected:
+            try:
+                await client.quit()
+            except (socket_error, aiosmtplib.SMTPException):
+                client.close()
+
+    async def close(self):
+        for slot in range(len(self.clients)):
+            await self._disconnect(slot)
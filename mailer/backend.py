@@ -1,13 +1,96 @@
+import json
+
+from email.mime.base import MIMEBase
+
 from django.core.mail.backends.base import BaseEmailBackend
+from django.utils.html import strip_tags
 
+from mailer import enqueue_messages
 from mailer.models import Message
 
 
 class DbBackend(BaseEmailBackend):
+    """
+    Email backend putting the messages on the mailer queue.
+
+    Every recipient (to, cc and bcc) gets a queued message of their own, which
+    keeps the To, Cc and Reply-To headers of the original.
+    """
+
     def send_messages(self, email_messages):
-        # allow for a custom batch size
-        messages = Message.objects.bulk_create(
-            [Message(email=email) for email in email_messages]
+        count = 0
+        messages = []
+        for email in email_messages:
+            queued = email_to_messages(email)
+            if not queued:
+                continue
+            count += 1
+            attachments = email_attachments(email)
+            if attachments:
+                enqueue_messages(queued, attachments)
+            else:
+                messages.extend(queued)
+
+        # Messages without attachments are inserted together
+        if messages:
+            enqueue_messages(messages)
+        return count
+
+
+def email_to_messages(email):
+    """
+    Return an unsaved Message for every recipient of the EmailMessage.
+    """
+    recipients = email.recipients()
+    headers = dict(email.extra_headers)
+    if len(recipients) > 1 or email.cc or email.bcc:
+        if email.to:
+            headers.setdefault("To", ", ".join(email.to))
+        if email.cc:
+            headers.setdefault("Cc", ", ".join(email.cc))
+    if email.reply_to:
+        headers.setdefault("Reply-To", ", ".join(email.reply_to))
+
+    message_body, html_body = email.body, ""
+    if email.content_subtype == "html":
+        message_body, html_body = strip_tags(email.body), email.body
+    alternatives = []
+    for content, mimetype in getattr(email, "alternatives", []):
+        if mimetype == "text/html" and not html_body:
+            html_body = content
+        else:
+            alternatives.append([content, mimetype])
+
+    return [
+        Message(
+            to_address=to_address,
+            from_address=email.from_email,
+            subject=email.subject,
+            message_body=message_body,
+            html_body=html_body,
+            headers=json.dumps(headers) if headers else "",
+            alternatives=json.dumps(alternatives) if alternatives else "",
         )
+        for to_address in recipients
+    ]
+
 
-        return len(messages)
+def email_attachments(email):
+    """
+    Return the attachments of the EmailMessage as (filename, content,
+    mimetype) tuples.
+    """
+    attachments = []
+    for attachment in email.attachments:
+        if isinstance(attachment, MIMEBase):
+            attachments.append(
+                (
+                    attachment.get_filename() or "",
+                    attachment.get_payload(decode=True),
+                    attachment.get_content_type(),
+                )
+            )
+        else:
+            filename, content, mimetype = attachment
+            attachments.append((filename or "", content, mimetype))
+    return attachments
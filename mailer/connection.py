@@ -0,0 +1,259 @@
+import random
+import smtplib
+import threading
+import time
+
+from socket import error as socket_error
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.message import sanitize_address
+
+from mailer import metrics
+from mailer.streaming import message_chunks, sendmail, streamed_parts
+
+# SMTP errors which mean the relay, not the message, is at fault
+RELAY_ERRORS = (
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPConnectError,
+    smtplib.SMTPHeloError,
+    smtplib.SMTPAuthenticationError,
+)
+
+
+def is_relay_error(err):
+    # SMTP errors are socket errors too, most of them caused by the message
+    if isinstance(err, smtplib.SMTPException):
+        return isinstance(err, RELAY_ERRORS)
+    return isinstance(err, socket_error)
+
+
+class ReusableConnection(object):
+    """
+    Keep one email backend connection open and send many messages over it.
+
+    The connection is opened lazily, recycled after ``max_messages`` messages
+    (when given) and reopened once if the server dropped it between messages.
+    ``opened`` counts how many connections were made.
+    """
+
+    def __init__(self, backend=None, max_messages=None, **kwargs):
+        self.backend = backend
+        self.max_messages = max_messages
+        self.kwargs = kwargs
+        self.connection = None
+        self.opened = 0
+        self.sent = 0
+
+    def open(self):
+        if self.connection is None:
+            connection = get_connection(
+                self.backend, fail_silently=False, **self.kwargs
+            )
+            with metrics.timer("smtp_connect"):
+                connection.open()
+            self.connection = connection
+            self.opened += 1
+            self.sent = 0
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except (socket_error, smtplib.SMTPException):
+                pass
+            self.connection = None
+
+    def send(self, email):
+        """
+        Send ``email`` and return the recipients the server refused, when it
+        accepted the others.
+        """
+        if self.max_messages and self.sent >= self.max_messages:
+            self.close()
+        try:
+            try:
+                refused = self._send(email)
+            except smtplib.SMTPServerDisconnected:
+                self.close()
+                refused = self._send(email)
+        except (smtplib.SMTPException, UnicodeEncodeError):
+            raise
+        except Exception:
+            # Maybe left in the middle of a transaction
+            self.close()
+            raise
+        self.sent += 1
+        return refused
+
+    def _send(self, email):
+        email.connection = self.open()
+        smtp = getattr(email.connection, "connection", None)
+        recipients = email.recipients()
+        parts = streamed_parts(email)
+        with metrics.timer("smtp_send"):
+            if isinstance(smtp, smtplib.SMTP) and (len(recipients) > 1 or parts):
+                # Email backends don't tell which recipients were refused, and
+                # need the whole message in memory
+                return self._sendmail(smtp, email, recipients)
+            for part in parts:
+                part.load()
+            email.send()
+        return {}
+
+    def _sendmail(self, smtp, email, recipients):
+        encoding = email.encoding or settings.DEFAULT_CHARSET
+        addresses = dict(
+            (sanitize_address(address, encoding), address) for address in recipients
+        )
+        refused = sendmail(
+            smtp,
+            sanitize_address(email.from_email, encoding),
+            list(addresses),
+            message_chunks(email),
+        )
+        return dict(
+            (addresses.get(address, address), error)
+            for address, error in refused.items()
+        )
+
+
+class ConnectionPool(object):
+    """
+    Hand out one ReusableConnection per thread, so messages can be delivered
+    from several threads at once.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    @property
+    def opened(self):
+        return sum(connection.opened for connection in self.connections)
+
+    def get(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = ReusableConnection(**self.kwargs)
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def send(self, email):
+        return self.get().send(email)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
+class Relay(object):
+    """
+    An SMTP server to send through, configured like an EMAIL_HOSTS entry.
+
+    After ``max_failures`` connection failures in a row the relay is left
+    alone for ``retry_after`` seconds, and then tried with a single message
+    again.
+    """
+
+    def __init__(self, name, config, max_failures=3, retry_after=60):
+        self.name = name
+        self.weight = config.get("weight", 1)
+        self.options = {}
+        for key, option in [
+            ("host", "host"),
+            ("port", "port"),
+            ("user", "username"),
+            ("password", "password"),
+            ("use_tls", "use_tls"),
+            ("use_ssl", "use_ssl"),
+            ("timeout", "timeout"),
+        ]:
+            if key in config:
+                self.options[option] = config[key]
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self.failures = 0
+        self.closed_until = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Relay %s>" % self.name
+
+    def available(self):
+        with self.lock:
+            if self.closed_until is None:
+                return True
+            if time.monotonic() < self.closed_until:
+                return False
+            # Half open: let one message through to find out if it's back
+            self.closed_until = time.monotonic() + self.retry_after
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.closed_until = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.closed_until = time.monotonic() + self.retry_after
+
+
+def weighted_order(relays):
+    """
+    Return the relays in random order, heavier ones more likely first.
+    """
+    return sorted(
+        relays,
+        key=lambda relay: random.random() ** (1.0 / max(relay.weight, 0.001)),
+        reverse=True,
+    )
+
+
+class RelayPool(object):
+    """
+    Spread messages over several relays by their weight, each with a
+    ConnectionPool of its own. A message which can't be sent because of its
+    relay is sent through the next one.
+    """
+
+    def __init__(self, relays, **kwargs):
+        self.relays = relays
+        self.pools = dict(
+            (relay.name, ConnectionPool(**dict(kwargs, **relay.options)))
+            for relay in relays
+        )
+
+    @property
+    def opened(self):
+        return sum(pool.opened for pool in self.pools.values())
+
+    def send(self, email):
+        relays = [relay for relay in weighted_order(self.relays) if relay.available()]
+        if not relays:
+            raise smtplib.SMTPConnectError(421, "No relay available")
+        for index, relay in enumerate(relays):
+            try:
+                refused = self.pools[relay.name].send(email)
+            except socket_error as err:
+                if not is_relay_error(err):
+                    raise
+                relay.failed()
+                metrics.increment("relay_failures", labels={"relay": relay.name})
+                self.pools[relay.name].get().close()
+                if index == len(relays) - 1:
+                    raise
+            else:
+                relay.succeeded()
+                return refused
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
@@ -1,16 +1,34 @@
+import os
 import time
+import socket
 import smtplib
+import threading
 
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from email import message_from_bytes
+from email.mime.base import MIMEBase
+from email.utils import formatdate, make_msgid
+from functools import partial
 from logging import getLogger
 from socket import error as socket_error
 
 from django.conf import settings
 from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail.message import forbid_multi_line_headers
+from django.core.mail.utils import DNS_NAME
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Q
 
-from mailer import lockfile
-from mailer.enums import RESULT_MAPPING
-from mailer.models import Message, DontSendEntry, MessageLog
-from mailer.settings import MAILER_EXTRA_HEADERS
+from mailer import lockfile, metrics, notify
+from mailer.connection import ConnectionPool, Relay, RelayPool
+from mailer.enums import PRIORITIES, RESULT_MAPPING
+from mailer.models import Blob, Message, MessageContent, MessageLog
+from mailer.settings import MAILER_EXTRA_HEADERS, MAILER_STREAM_ATTACHMENTS_SIZE
+from mailer.streaming import AttachmentPart
+from mailer.suppression import DontSendIndex, combine_patterns
+from mailer.throttle import DOMAIN_RATE_LIMITS, RATE_LIMIT, RateLimiter
 
 
 logger = getLogger(__name__)
@@ -21,28 +39,147 @@ LOCK_WAIT_TIMEOUT = getattr(settings, "MAILER_LOCK_WAIT_TIMEOUT", -1)
 
 WHITELIST = getattr(settings, "MAILER_WHITELIST", None)
 
+WHITELIST_PATTERNS = combine_patterns(WHITELIST or [])
 
-def prioritize():
+BATCH_SIZE = getattr(settings, "MAILER_BATCH_SIZE", 100)
+
+# Reconnect after this many messages, None keeps one connection per pass
+CONNECTION_MAX_MESSAGES = getattr(settings, "MAILER_CONNECTION_MAX_MESSAGES", None)
+
+# Number of threads delivering messages in parallel during a pass
+CONCURRENCY = getattr(settings, "MAILER_CONCURRENCY", 1)
+
+# Seconds a worker may hold claimed messages before others can take them over
+LEASE_SECONDS = getattr(settings, "MAILER_LEASE_SECONDS", 300)
+
+# SMTP servers to spread mail over, configured like EMAIL_HOSTS with an
+# optional "weight"
+RELAYS = getattr(settings, "MAILER_RELAYS", None)
+
+# A relay failing this many times in a row is left alone for
+# MAILER_RELAY_RETRY_AFTER seconds
+RELAY_MAX_FAILURES = getattr(settings, "MAILER_RELAY_MAX_FAILURES", 3)
+RELAY_RETRY_AFTER = getattr(settings, "MAILER_RELAY_RETRY_AFTER", 60)
+
+# Messages with the same content for the same domain are sent as one email to
+# up to this many recipients, when they share their To header
+GROUP_MAX_RECIPIENTS = getattr(settings, "MAILER_GROUP_MAX_RECIPIENTS", 50)
+
+# Group messages which don't share a To header as well, addressed to
+# "undisclosed-recipients:;"
+GROUP_RECIPIENTS = getattr(settings, "MAILER_GROUP_RECIPIENTS", False)
+
+UNDISCLOSED_RECIPIENTS = "undisclosed-recipients:;"
+
+# Seconds send_loop waits at least after a pass which left rate limited mail
+# queued, until a rate limit has a token again otherwise
+THROTTLE_SLEEP = getattr(settings, "MAILER_THROTTLE_SLEEP", 1)
+
+
+SEND_ERRORS = (
+    socket_error,
+    UnicodeEncodeError,
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPAuthenticationError,
+    smtplib.SMTPDataError,
+)
+
+
+# The don't send list, kept in memory between passes
+dont_send = DontSendIndex()
+
+# Relays by name, keeping track of their health between passes
+relays = {}
+
+# Rate limits of sending, see mailer.throttle
+throttle = RateLimiter(RATE_LIMIT, DOMAIN_RATE_LIMITS)
+
+# Messages sent, deferred, skipped and throttled by this process
+totals = Counter()
+
+# Set to stop send_loop, and the pass it is in after the mail being sent
+stopping = threading.Event()
+
+
+def prioritize_batches(batch_size=None):
     """
-    Yield the messages in the queue in the order they should be sent.
+    Yield lists of messages in the order they should be sent.
+
+    The queue is scanned in batches ordered by (priority, when_added, id) using
+    keyset pagination, so a pass costs one query per batch. Between batches,
+    messages of a higher priority than the current position which arrived
+    during the pass are picked up first. Shared content is filled in, fetched
+    once per pass.
     """
+    batch_size = batch_size or BATCH_SIZE
+    contents = {}
+    queue = (
+        Message.objects.available()
+        .order_by("priority", "when_added", "id")
+        .select_related("rendered")
+        .prefetch_related("attachment_set__blob")
+    )
+    last = None
+    max_id = 0
     while True:
-        while Message.objects.high_priority().count():
-            for message in Message.objects.high_priority().order_by("when_added"):
-                yield message
-        while (
-            Message.objects.high_priority().count() == 0
-            and Message.objects.medium_priority().count()
-        ):
-            yield Message.objects.medium_priority().order_by("when_added")[0]
-        while (
-            Message.objects.high_priority().count() == 0
-            and Message.objects.medium_priority().count() == 0
-            and Message.objects.low_priority().count()
-        ):
-            yield Message.objects.low_priority().order_by("when_added")[0]
-        if Message.objects.non_deferred().count() == 0:
+        if last is None:
+            batch = list(queue[:batch_size])
+        else:
+            priority, when_added, pk = last
+            batch = list(
+                queue.filter(
+                    Q(priority__lt=priority, id__gt=max_id)
+                    | Q(priority=priority, when_added__gt=when_added)
+                    | Q(priority=priority, when_added=when_added, id__gt=pk)
+                    | Q(priority__gt=priority)
+                )[:batch_size]
+            )
+        if not batch:
             break
+        # Keys are taken before yielding, consumers may delete the messages
+        for message in batch:
+            key = (message.priority, message.when_added, message.id)
+            max_id = max(max_id, message.id)
+            if last is None or key > last:
+                last = key
+        fill_contents(batch, contents)
+        yield batch
+
+
+def claim_batches(worker_id, batch_size=None):
+    """
+    Yield batches of messages claimed by ``worker_id``.
+
+    Other workers never get the same messages while the lease runs. Messages
+    left in the queue (e.g. deferred or rate limited ones) stay claimed until
+    the pass is over, so they are not claimed again by the same pass.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    contents = {}
+    try:
+        while True:
+            batch = Message.objects.claim(worker_id, batch_size, LEASE_SECONDS)
+            if not batch:
+                break
+            fill_contents(batch, contents)
+            yield batch
+    finally:
+        Message.objects.release(worker_id)
+
+
+def get_worker_id():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+def prioritize(batch_size=None):
+    """
+    Yield the messages in the queue in the order they should be sent.
+    """
+    for batch in prioritize_batches(batch_size):
+        for message in batch:
+            yield message
 
 
 def in_whitelist(address):
@@ -52,123 +189,629 @@ def in_whitelist(address):
     if WHITELIST is None:
         return True
     else:
-        return any(regex.search(address) for regex in WHITELIST)
+        return any(regex.search(address) for regex in WHITELIST_PATTERNS)
 
 
-def send_all(limit=None, use_locking=True):
+def send_all(limit=None, use_locking=True, worker=False, concurrency=None):
     """
     Send all eligible messages in the queue.
+
+    In ``worker`` mode messages are claimed in batches instead, so any number
+    of processes on any number of hosts can send at the same time.
+    ``concurrency`` is the number of threads delivering messages.
+    """
+    run_pass(send_messages_queued, limit, use_locking, worker, concurrency=concurrency)
+
+
+def run_pass(send_messages, limit=None, use_locking=True, worker=False, **kwargs):
+    """
+    Do one pass through the queue with ``send_messages``, a
+    ``send_messages_queued`` implementation, holding the lock unless running
+    in ``worker`` mode.
     """
-    # Get lock so only one process sends at the same time
-    lock_cls = lockfile.FileLock if use_locking else lockfile.NoopLock
     try:
-        with lock_cls("send_mail"):
-            setup_smtp_settings()
-            send_messages_queued(limit)
-    except lockfile.AlreadyLocked:
-        logger.info("Already locked.")
-        return
-    except lockfile.LockTimeout:
-        logger.info("Lock timed out.")
-        return
+        if worker:
+            send_messages(limit, worker_id=get_worker_id(), **kwargs)
+            return
 
+        # Get lock so only one process sends at the same time
+        lock_cls = lockfile.FileLock if use_locking else lockfile.NoopLock
+        try:
+            with lock_cls("send_mail"):
+                send_messages(limit, **kwargs)
+        except lockfile.AlreadyLocked:
+            logger.info("Already locked.")
+            return
+        except lockfile.LockTimeout:
+            logger.info("Lock timed out.")
+            return
+    finally:
+        if metrics.enabled():
+            # Neither failing after sending nor hiding why the pass failed
+            try:
+                record_queue_depth()
+                metrics.flush()
+            except Exception:
+                logger.exception("Recording metrics failed.")
 
-def setup_smtp_settings():
-    # Check for multiple mail hosts
-    hosts = getattr(settings, "EMAIL_HOSTS", None)
-    if hosts is not None:
+
+def get_relays():
+    """
+    Return the relays to send through: those in MAILER_RELAYS, or the
+    EMAIL_HOSTS whose gargoyle switch is active. Without any, mail is sent
+    through the EMAIL_HOST of the email backend.
+    """
+    configs = RELAYS
+    if configs is None:
+        hosts = getattr(settings, "EMAIL_HOSTS", None)
+        if hosts is None:
+            return []
         from gargoyle import gargoyle
 
-        for host, config in list(hosts.items()):
-            if gargoyle.is_active("mailer-%s" % host):
-                settings.EMAIL_HOST = config["host"]
-                settings.EMAIL_USE_TLS = config["use_tls"]
-                settings.EMAIL_PORT = config["port"]
-                settings.EMAIL_HOST_USER = config["user"]
-                settings.EMAIL_HOST_PASSWORD = config["password"]
-                break
+        configs = dict(
+            (host, config)
+            for host, config in hosts.items()
+            if gargoyle.is_active("mailer-%s" % host)
+        )
+
+    active = []
+    for name, config in configs.items():
+        if name not in relays:
+            relays[name] = Relay(name, config, RELAY_MAX_FAILURES, RELAY_RETRY_AFTER)
+        active.append(relays[name])
+    return active
 
 
-def send_messages_queued(limit):
-    # Start sending mails
+def queue_batches(worker_id=None):
+    if worker_id is not None:
+        return claim_batches(worker_id)
+    return prioritize_batches()
+
+
+def send_messages_queued(limit, worker_id=None, concurrency=None):
+    batches = queue_batches(worker_id)
+    concurrency = concurrency or CONCURRENCY
+
+    # Start sending mails, reusing one connection per thread (and relay) for
+    # the whole pass
+    options = dict(backend=get_email_backend(), max_messages=CONNECTION_MAX_MESSAGES)
+    active = get_relays()
+    pool = RelayPool(active, **options) if active else ConnectionPool(**options)
+    executor = ThreadPoolExecutor(concurrency) if concurrency > 1 else None
+    try:
+        total = process_batches(
+            batches, limit, partial(_deliver, pool, executor), worker_id
+        )
+    finally:
+        batches.close()
+        if executor is not None:
+            executor.shutdown()
+        pool.close()
+    logger.info(
+        "%s message(s) processed using %s connection(s)." % (total, pool.opened)
+    )
+    return total
+
+
+def process_batches(batches, limit, deliver, worker_id=None):
+    """
+    Send the messages in ``batches``, passing the emails of each batch to
+    ``deliver`` which returns the error each of them failed with, a dict of
+    the recipients refused by the server, or None for those it didn't get to
+    before the deadline it is given or stopping.
+
+    With the ``worker_id`` of the claimed batches, their lease is renewed
+    before they are delivered, and only the messages still claimed by the
+    worker are removed or deferred.
+    """
     total = 0
-    for message in prioritize():
-        # Check limit
-        if limit is not None and total >= int(limit):
-            logger.info("Limit (%s) reached, stopping." % limit)
+    dont_send.refresh(force=True)
+    throttle.reset()
+    batches = iter(batches)
+    while True:
+        with metrics.timer("batch_fetch"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        if stopping.is_set():
+            logger.info("Stopping.")
             break
 
-        # Check whitelist and don't send list
-        if DontSendEntry.objects.has_address(message.to_address) or not in_whitelist(
-            message.to_address
-        ):
-            logger.info(
-                "Skipping mail to %s - on don't send list." % message.to_address
-            )
-            MessageLog.objects.log(message, RESULT_MAPPING["don't send"])
-            message.delete()
-        else:
-            try:
+        # Check limit
+        if limit is not None:
+            if total >= int(limit):
+                logger.info("Limit (%s) reached, stopping." % limit)
+                break
+            batch = batch[: int(limit) - total]
+
+        # Start no delivery past half the lease, leaving the rest of it for
+        # the ones in progress and recording the outcome
+        deadline = None
+        if worker_id is not None:
+            held = Message.objects.renew(worker_id, batch, LEASE_SECONDS)
+            if len(held) < len(batch):
+                logger.warning(
+                    "%s message(s) taken over by another worker."
+                    % (len(batch) - len(held))
+                )
+                batch = [message for message in batch if message.pk in held]
+            deadline = time.monotonic() + LEASE_SECONDS / 2
+
+        # Log entries of the batch are written together at the end
+        logs = []
+
+        # Check whitelist and don't send list for the whole batch
+        dont_send.refresh()
+        blocked = dont_send.filter(message.to_address for message in batch)
+        pending, skipped = [], []
+        for message in batch:
+            if message.to_address in blocked or not in_whitelist(message.to_address):
                 logger.info(
-                    "Sending message to %s" % message.to_address
+                    "Skipping mail to %s - on don't send list." % message.to_address
+                )
+                logs.append(
+                    MessageLog.objects.build(message, RESULT_MAPPING["don't send"])
                 )
-                # Prepare body
-                if message.html_body:
-                    msg = EmailMultiAlternatives(
-                        message.subject,
-                        message.message_body,
-                        message.from_address,
-                        [message.to_address],
-                        headers=MAILER_EXTRA_HEADERS,
-                    )
-                    msg.attach_alternative(message.html_body, "text/html")
+                skipped.append(message)
+            else:
+                logger.info("Sending message to %s" % message.to_address)
+                pending.append(message)
+            total += 1
+
+        # Rate limited messages stay on the queue for a later pass, while the
+        # messages for other domains are sent
+        pending, throttled = throttle.allow(pending)
+        if throttled:
+            logger.info("%s message(s) rate limited." % len(throttled))
+            _count("throttled", len(throttled))
+            total -= len(throttled)
+
+        # Only the delivery itself runs in the pool, database writes happen
+        # here once the whole batch is done
+        rendered = {}
+        sent, failed, unattempted = [], [], []
+        groups, emails = [], []
+        for group in group_messages(pending):
+            try:
+                emails.append(_prepare_email(group, rendered))
+            except Exception as err:
+                # E.g. a missing attachment file, only this message is
+                # affected
+                logger.exception("Preparing the message failed.")
+                failed.extend((message, err) for message in group)
+                continue
+            groups.append(group)
+        for group, result in zip(groups, deliver(emails, deadline)):
+            if result is None:
+                # Stays on the queue for the next pass
+                unattempted.extend(group)
+                continue
+            for message in group:
+                err = result
+                if isinstance(result, dict):
+                    # Delivered, but maybe not to every recipient
+                    err = None
+                    if message.to_address in result:
+                        err = smtplib.SMTPRecipientsRefused(
+                            {message.to_address: result[message.to_address]}
+                        )
+                if err is not None:
+                    logger.info("Message deferred due to failure: %s" % err)
+                    failed.append((message, err))
                 else:
-                    msg = EmailMessage(
-                        message.subject,
-                        message.message_body,
-                        message.from_address,
-                        [message.to_address],
-                        headers=MAILER_EXTRA_HEADERS,
-                    )
-
-                # Prepare attachments
-                for attachment in message.attachment_set.all():
-                    mimetype = attachment.mimetype or "application/octet-stream"
-                    msg.attach(
-                        attachment.filename, attachment.attachment_file.read(), mimetype
-                    )
-
-                # Do actual send
-                msg.send()
-            except (
-                socket_error,
-                UnicodeEncodeError,
-                smtplib.SMTPSenderRefused,
-                smtplib.SMTPRecipientsRefused,
-                smtplib.SMTPAuthenticationError,
-                smtplib.SMTPDataError,
-            ) as err:
-                # Sending failed, defer message
-                message.defer()
-                logger.info("Message deferred due to failure: %s" % err)
-                MessageLog.objects.log(
+                    sent.append(message)
+        if unattempted:
+            logger.info("%s message(s) left for the next pass." % len(unattempted))
+            total -= len(unattempted)
+
+        # Apply the outcome of the batch with a few statements, whatever its size
+        with transaction.atomic(using=Message.objects.db):
+            Message.objects.defer_many([message for message, _ in failed], worker_id)
+            logs.extend(
+                MessageLog.objects.build(
                     message, RESULT_MAPPING["failure"], log_message=str(err)
                 )
-            else:
-                # Sending succeeded
-                MessageLog.objects.log(message, RESULT_MAPPING["success"])
-                message.delete()
-        total += 1
+                for message, err in failed
+            )
+            logs.extend(
+                MessageLog.objects.build(message, RESULT_MAPPING["success"])
+                for message in sent
+            )
+            done = [message.pk for message in skipped + sent]
+            if done:
+                queryset = Message.objects.filter(pk__in=done)
+                if worker_id is not None:
+                    queryset = queryset.filter(claimed_by=worker_id)
+                queryset.delete()
+            MessageLog.objects.bulk_create(logs)
+        _count("skipped", len(skipped))
+        _count("deferred", len(failed))
+        _count("sent", len(sent))
     return total
 
 
-def send_loop():
+def fill_contents(messages, contents):
     """
-    Loop indefinitely, checking queue at intervals of EMPTY_QUEUE_SLEEP and
-    sending messages if any are on queue.
+    Fill in the subject and bodies of messages with shared content, fetching
+    the content missing from the ``contents`` cache.
     """
+    missing = set(
+        message.content_id
+        for message in messages
+        if message.content_id is not None and message.content_id not in contents
+    )
+    if missing:
+        contents.update(MessageContent.objects.in_bulk(missing))
+    for message in messages:
+        if message.content_id is not None:
+            message.fill_content(contents[message.content_id])
 
-    while True:
-        while Message.objects.count() == 0:
-            time.sleep(EMPTY_QUEUE_SLEEP)
-        send_all()
+
+def _count(outcome, value=1):
+    totals[outcome] += value
+    metrics.increment("messages_%s" % outcome, value)
+
+
+def _read_attachment(attachment):
+    with metrics.timer("attachment_read"):
+        return attachment.read()
+
+
+def record_queue_depth():
+    """
+    Record the number of messages waiting in each priority.
+    """
+    depth = dict(
+        Message.objects.ready()
+        .order_by()
+        .values_list("priority")
+        .annotate(count=Count("id"))
+    )
+    for priority, label in PRIORITIES:
+        metrics.gauge("queue_depth", depth.get(priority, 0), {"priority": label})
+
+
+def group_messages(messages):
+    """
+    Split ``messages`` in lists of messages which can be sent as one email:
+    those with the same content, To header and recipient domain.
+    """
+    groups = OrderedDict()
+    for message in messages:
+        if GROUP_MAX_RECIPIENTS > 1 and (
+            GROUP_RECIPIENTS or "To" in message.get_headers()
+        ):
+            key = content_fingerprint(message)
+        else:
+            key = message.pk
+        groups.setdefault(key, []).append(message)
+    return [
+        group[start : start + max(GROUP_MAX_RECIPIENTS, 1)]
+        for group in groups.values()
+        for start in range(0, len(group), max(GROUP_MAX_RECIPIENTS, 1))
+    ]
+
+
+def content_fingerprint(message):
+    attachments = tuple(
+        (attachment.filename, attachment.mimetype, attachment.file.name)
+        for attachment in message.attachment_set.all()
+    )
+    return (
+        message.from_address,
+        message.subject,
+        message.message_body,
+        message.html_body,
+        message.headers,
+        message.alternatives,
+        message.rendered_id,
+        attachments,
+        message.to_address.rpartition("@")[2].lower(),
+    )
+
+
+def _prepare_email(group, rendered):
+    """
+    Build the email for a group of queued messages with the same content, to
+    all their recipients. ``rendered`` caches the content of pre-rendered
+    messages within a batch.
+    """
+    message = group[0]
+    recipients = [member.to_address for member in group]
+    to_header = message.to_address if len(group) == 1 else UNDISCLOSED_RECIPIENTS
+    if message.rendered_id is None:
+        attachments = []
+        for attachment in message.attachment_set.all():
+            if attachment.size > MAILER_STREAM_ATTACHMENTS_SIZE:
+                # Read while the email is sent instead
+                attachments.append(AttachmentPart(attachment))
+                continue
+            content = _read_attachment(attachment)
+            attachments.append((attachment.filename, content, attachment.mimetype))
+        email = build_email(message, attachments)
+        email.to = recipients
+        if "To" not in email.extra_headers and len(group) > 1:
+            email.extra_headers["To"] = to_header
+        return email
+
+    if message.rendered_id not in rendered:
+        blob = message.rendered
+        blob.file.open("rb")
+        try:
+            rendered[message.rendered_id] = blob.file.read()
+        finally:
+            blob.file.close()
+    data = rendered[message.rendered_id]
+    # The headers which differ for every email aren't part of the rendering,
+    # unless they were given with the message
+    present = rendered_headers(data)
+    headers = [
+        ("To", to_header),
+        ("Date", formatdate(localtime=settings.EMAIL_USE_LOCALTIME)),
+        ("Message-ID", make_msgid(domain=DNS_NAME)),
+    ]
+    for name, value in reversed(headers):
+        if name.lower() not in present:
+            name, value = forbid_multi_line_headers(
+                name, value, settings.DEFAULT_CHARSET
+            )
+            data = ("%s: %s\r\n" % (name, value)).encode("ascii") + data
+    return RenderedEmailMessage(data, message.from_address, recipients)
+
+
+def rendered_headers(data):
+    """
+    Return the lowercase names of the headers of the rendered ``data``.
+    """
+    head = data.partition(b"\r\n\r\n")[0]
+    return set(
+        line.partition(b":")[0].decode("ascii", "replace").strip().lower()
+        for line in head.split(b"\r\n")
+        if line and not line[:1].isspace()
+    )
+
+
+def build_email(message, attachments):
+    """
+    Build the email for a message and its (filename, content, mimetype)
+    ``attachments``, or MIME parts.
+    """
+    headers = dict(MAILER_EXTRA_HEADERS or {})
+    headers.update(message.get_headers())
+    alternatives = message.get_alternatives()
+
+    # Prepare body
+    if message.html_body or alternatives:
+        msg = EmailMultiAlternatives(
+            message.subject,
+            message.message_body,
+            message.from_address,
+            [message.to_address],
+            headers=headers,
+        )
+        if message.html_body:
+            msg.attach_alternative(message.html_body, "text/html")
+        for content, mimetype in alternatives:
+            msg.attach_alternative(content, mimetype)
+    else:
+        msg = EmailMessage(
+            message.subject,
+            message.message_body,
+            message.from_address,
+            [message.to_address],
+            headers=headers,
+        )
+
+    # Prepare attachments
+    for attachment in attachments:
+        if isinstance(attachment, MIMEBase):
+            msg.attach(attachment)
+            continue
+        filename, content, mimetype = attachment
+        msg.attach(filename, content, mimetype or "application/octet-stream")
+    return msg
+
+
+def prerender(messages, attachments=None):
+    """
+    Render the unsaved ``messages`` (without their To, Date and Message-ID
+    headers) with the
+    stored (filename, blob, mimetype) ``attachments``, and store the result
+    as blobs, once for every distinct content. Messages with variables are
+    left to be rendered when they are sent.
+    """
+    blobs = {}
+    for message in messages:
+        if message.context:
+            # Differs for every recipient
+            continue
+        source = message
+        if message.content is not None:
+            source = copy(message)
+            source.fill_content(message.content)
+        key = (
+            source.from_address,
+            source.subject,
+            source.message_body,
+            source.html_body,
+            source.headers,
+            source.alternatives,
+        )
+        if key not in blobs:
+            email = build_email(
+                source,
+                [
+                    (filename, blob.read(), mimetype)
+                    for filename, blob, mimetype in attachments or []
+                ],
+            )
+            email.to = []
+            mime = email.message()
+            # Added for every recipient when the message is sent
+            given = set(name.lower() for name in source.get_headers())
+            for name in ["Date", "Message-ID"]:
+                if name.lower() not in given:
+                    del mime[name]
+            blobs[key] = Blob.objects.from_content(mime.as_bytes(linesep="\r\n"))
+        message.rendered = blobs[key]
+
+
+class RenderedEmailMessage(EmailMessage):
+    """
+    An email whose MIME content was rendered when it was queued.
+    """
+
+    def __init__(self, data, from_email, to):
+        super(RenderedEmailMessage, self).__init__(from_email=from_email, to=to)
+        self.data = data
+
+    def message(self):
+        return RenderedMIMEMessage(self.data)
+
+
+class RenderedMIMEMessage(object):
+    """
+    Stands in for the email.message.Message of a RenderedEmailMessage. The
+    rendered bytes are sent as they are, and only parsed when the message is
+    looked into or changed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.parsed = None
+
+    def parse(self):
+        if self.parsed is None:
+            self.parsed = message_from_bytes(self.data)
+        return self.parsed
+
+    def as_bytes(self, unixfrom=False, linesep="\n"):
+        if self.parsed is not None:
+            policy = self.parsed.policy.clone(linesep=linesep)
+            return self.parsed.as_bytes(unixfrom, policy=policy)
+        if linesep == "\r\n":
+            return self.data
+        return self.data.replace(b"\r\n", linesep.encode("ascii"))
+
+    def as_string(self, unixfrom=False, linesep="\n"):
+        return self.as_bytes(unixfrom, linesep=linesep).decode("utf-8", "replace")
+
+    def __getattr__(self, name):
+        return getattr(self.parse(), name)
+
+    def __getitem__(self, name):
+        return self.parse()[name]
+
+    def __setitem__(self, name, value):
+        self.parse()[name] = value
+
+    def __delitem__(self, name):
+        del self.parse()[name]
+
+    def __contains__(self, name):
+        return name in self.parse()
+
+    def __iter__(self):
+        return iter(self.parse())
+
+    def __len__(self):
+        return len(self.parse())
+
+
+def get_email_backend():
+    """
+    The backend actually delivering the mail, MAILER_EMAIL_BACKEND if set.
+    """
+    backend = getattr(settings, "MAILER_EMAIL_BACKEND", None) or settings.EMAIL_BACKEND
+    if backend == "mailer.backend.DbBackend":
+        # Delivering would just put the mail back on the queue
+        backend = "django.core.mail.backends.smtp.EmailBackend"
+    return backend
+
+
+def _deliver(pool, executor, emails, deadline=None):
+    """
+    Send the emails, in the pool's threads if there is one, and return the
+    error each of them failed with, or the recipients refused by the server.
+    Emails not started before the ``deadline`` (a time.monotonic() value),
+    or once stopping, get None.
+    """
+
+    def send(email):
+        if stopping.is_set():
+            return None
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        try:
+            return pool.send(email)
+        except SEND_ERRORS as err:
+            return err
+        except Exception as err:
+            # Never lose the outcome of the emails already sent in the batch
+            logger.exception("Sending the message failed.")
+            return err
+
+    if executor is None:
+        return [send(email) for email in emails]
+    return list(executor.map(send, emails))
+
+
+def send_loop(send=None, use_locking=True, worker=False, after_pass=None, **kwargs):
+    """
+    Loop until ``stopping`` is set, sending messages as soon as they are put
+    on the queue. Without notifications, the queue is checked at intervals of
+    EMPTY_QUEUE_SLEEP.
+
+    ``send`` is the ``send_all`` to use and ``after_pass`` is called after
+    every pass. Unless in ``worker`` mode, the lock is held for as long as
+    the loop runs.
+    """
+    send = send or send_all
+    locking = use_locking and not worker
+    lock_cls = lockfile.FileLock if locking else lockfile.NoopLock
+    try:
+        with lock_cls("send_mail"):
+            # Only listen once the lock is held, or a loop failing to start
+            # would take notifications from the running one
+            listener = notify.listen()
+            try:
+                _loop(listener, send, worker, after_pass, **kwargs)
+            finally:
+                listener.close()
+    except lockfile.AlreadyLocked:
+        logger.info("Already locked.")
+    except lockfile.LockTimeout:
+        logger.info("Lock timed out.")
+
+
+def _loop(listener, send, worker, after_pass, **kwargs):
+    while not stopping.is_set():
+        throttled = totals["throttled"]
+        try:
+            send(use_locking=False, worker=worker, **kwargs)
+        except Exception:
+            logger.exception("Sending failed, retrying after a pause.")
+        # Don't keep database connections open while waiting, or beyond
+        # their CONN_MAX_AGE
+        close_old_connections()
+        if after_pass is not None:
+            try:
+                after_pass()
+            except Exception:
+                logger.exception("After pass hook failed.")
+        if totals["throttled"] > throttled:
+            # Come back for the rate limited mail once it may be sent
+            _wait(listener, max(throttle.refill_delay() or 0, THROTTLE_SLEEP))
+        else:
+            _wait(listener, EMPTY_QUEUE_SLEEP)
+
+
+def _wait(listener, timeout):
+    """
+    Wait until notified, for ``timeout`` seconds at most, or until stopping.
+    """
+    deadline = time.monotonic() + timeout
+    while not stopping.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or listener.wait(min(remaining, 1)):
+            return
@@ -0,0 +1,125 @@
+"""
+Text fields stored compressed when ``MAILER_COMPRESS_BODIES`` names a
+method, "zlib" or "zstd" (which needs the zstandard package).
+
+Compressed values are kept as text, a header naming the method followed by
+the base64 of the compressed UTF-8, so the column doesn't change and values
+written before compression was enabled stay readable.
+"""
+import base64
+import zlib
+
+from functools import lru_cache
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.functions import Length
+
+from mailer.settings import MAILER_COMPRESS_BODIES, MAILER_COMPRESS_MIN_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADERS = {"zlib": "\x01Z", "zstd": "\x01S"}
+
+METHODS = dict((header, method) for method, header in HEADERS.items())
+
+
+def compressed(value):
+    return value[:2] in METHODS
+
+
+@lru_cache(maxsize=16)
+def compress(value, method):
+    if method == "zstd":
+        data = _zstandard().ZstdCompressor().compress(value.encode("utf-8"))
+    else:
+        data = zlib.compress(value.encode("utf-8"))
+    return HEADERS[method] + base64.b64encode(data).decode("ascii")
+
+
+@lru_cache(maxsize=16)
+def decompress(value):
+    data = base64.b64decode(value[2:])
+    if METHODS[value[:2]] == "zstd":
+        data = _zstandard().ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
+
+
+def _zstandard():
+    if zstandard is None:
+        raise ImproperlyConfigured("zstd compression requires zstandard.")
+    return zstandard
+
+
+class CompressedTextField(models.TextField):
+    """
+    TextField compressing values of MAILER_COMPRESS_MIN_SIZE characters or
+    more when they are saved. Lookups compare against the stored text, so
+    they don't match compressed values.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if value is not None and compressed(value):
+            return decompress(value)
+        return value
+
+    def get_db_prep_save(self, value, connection):
+        value = super(CompressedTextField, self).get_db_prep_save(value, connection)
+        method = MAILER_COMPRESS_BODIES
+        if method is True:
+            method = "zlib"
+        if (
+            method
+            and isinstance(value, str)
+            and len(value) >= MAILER_COMPRESS_MIN_SIZE
+            and not compressed(value)
+        ):
+            return compress(value, method)
+        return value
+
+
+def compress_rows(queryset, chunk_size=500):
+    """
+    Compress the values of the compressed text fields of the rows in
+    ``queryset`` which were saved uncompressed, ``chunk_size`` rows per
+    transaction. Returns the number of rows compressed.
+    """
+    model = queryset.model
+    names = [
+        field.name
+        for field in model._meta.concrete_fields
+        if isinstance(field, CompressedTextField)
+    ]
+    pending = Q()
+    for name in names:
+        length = "%s_length" % name
+        queryset = queryset.annotate(**{length: Length(name)})
+        uncompressed = Q(**{"%s__gte" % length: MAILER_COMPRESS_MIN_SIZE})
+        for header in HEADERS.values():
+            uncompressed &= ~Q(**{"%s__startswith" % name: header})
+        pending |= uncompressed
+    queryset = queryset.filter(pending).order_by("pk")
+
+    count = 0
+    last = None
+    while True:
+        with transaction.atomic(using=queryset.db):
+            rows = queryset
+            if last is not None:
+                rows = rows.filter(pk__gt=last)
+            rows = list(rows.values_list("pk", *names)[:chunk_size])
+            if not rows:
+                return count
+            for row in rows:
+                # Saved values are compressed by the fields
+                model._default_manager.using(queryset.db).filter(pk=row[0]).update(
+                    **dict(zip(names, row[1:]))
+                )
+        count += len(rows)
+        last = rows[-1][0]
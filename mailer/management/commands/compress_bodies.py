@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailer import fields
+from mailer.models import Message, MessageContent, MessageLog
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compress the bodies of queued messages, their shared content and "
+        "message log entries saved before MAILER_COMPRESS_BODIES was set."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            dest="chunk_size",
+            action="store",
+            type=int,
+            default=500,
+            help="Rows compressed per transaction (default 500).",
+        )
+
+    def handle(self, **options):
+        if not fields.MAILER_COMPRESS_BODIES:
+            raise CommandError("MAILER_COMPRESS_BODIES is not set.")
+        for model in [MessageContent, Message, MessageLog]:
+            count = fields.compress_rows(
+                model.objects.all(), chunk_size=options["chunk_size"]
+            )
+            logger.info("%s %s row(s) compressed" % (count, model._meta.verbose_name))
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from mailer.models import Blob, MessageContent
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete stored attachment and message content no queued message refers "
+        "to anymore."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-period",
+            dest="grace_period",
+            action="store",
+            type=int,
+            default=3600,
+            help="Keep content used within this many seconds (default 3600).",
+        )
+
+    def handle(self, **options):
+        grace_period = timedelta(seconds=options["grace_period"])
+        count = Blob.objects.collect_garbage(grace_period=grace_period)
+        logger.info("%s attachment blob(s) deleted" % count)
+        count = MessageContent.objects.collect_garbage(grace_period=grace_period)
+        logger.info("%s message content(s) deleted" % count)
@@ -0,0 +1,71 @@
+import gzip
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from mailer.enums import RESULT_MAPPING
+from mailer.models import MessageLog
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Delete (and optionally archive) old entries of the message log."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            dest="days",
+            action="store",
+            type=int,
+            default=90,
+            help="Keep entries attempted within this many days (default 90).",
+        )
+        for result in RESULT_MAPPING:
+            option = result.replace("'", "").replace(" ", "-")
+            parser.add_argument(
+                "--%s-days" % option,
+                dest=result,
+                action="store",
+                type=int,
+                help="Keep %s entries for this many days instead." % result,
+            )
+        parser.add_argument(
+            "--archive",
+            dest="archive",
+            action="store",
+            help="Append the deleted entries as JSON lines to this gzip file.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            dest="chunk_size",
+            action="store",
+            type=int,
+            default=1000,
+            help="Delete this many entries per transaction (default 1000).",
+        )
+
+    def handle(self, **options):
+        archive = None
+        if options["archive"]:
+            archive = gzip.open(options["archive"], "at", encoding="utf-8")
+        now = timezone.now()
+        count = 0
+        try:
+            for result, code in RESULT_MAPPING.items():
+                days = options[result]
+                if days is None:
+                    days = options["days"]
+                count += MessageLog.objects.purge(
+                    now - timedelta(days=days),
+                    results=[code],
+                    chunk_size=options["chunk_size"],
+                    archive=archive,
+                )
+        finally:
+            if archive is not None:
+                archive.close()
+        logger.info("%s log entry(ies) purged" % count)
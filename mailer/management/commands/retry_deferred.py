@@ -7,8 +7,18 @@ logger = getLogger(__name__)
 
 
 class Command(BaseCommand):
-    help = "Attempt to resend any deferred mail."
+    help = "Attempt to resend deferred mail whose next attempt is due."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            "-a",
+            dest="due_only",
+            action="store_false",
+            default=True,
+            help="Retry all deferred mail, even if its next attempt isn't due.",
+        )
 
     def handle(self, **options):
-        count = Message.objects.retry_deferred()
+        count = Message.objects.retry_deferred(due_only=options["due_only"])
         logger.info("%s message(s) retried" % count)
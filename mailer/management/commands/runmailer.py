@@ -0,0 +1,175 @@
+import json
+import os
+import signal
+import sys
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mailer import async_engine, engine
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Keep sending mail as it is put on the queue, until stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--no-lock",
+            "-n",
+            dest="use_locking",
+            action="store_false",
+            default=True,
+            help="Do not use local mailer lock.",
+        )
+        parser.add_argument(
+            "--worker",
+            "-w",
+            dest="worker",
+            action="store_true",
+            default=False,
+            help="Claim messages in batches instead of holding the local mailer "
+            "lock, so several workers can send at the same time.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            "-c",
+            dest="concurrency",
+            action="store",
+            type=int,
+            help="The number of threads (or SMTP connections with the async "
+            "engine) delivering mails.",
+        )
+        parser.add_argument(
+            "--engine",
+            "-e",
+            dest="engine",
+            choices=["sync", "async"],
+            default="sync",
+            help="Deliver mails from threads (sync) or from an asyncio event "
+            "loop using aiosmtplib (async).",
+        )
+        parser.add_argument(
+            "--heartbeat",
+            dest="heartbeat",
+            action="store",
+            help="Write the time of the last pass and the number of mails sent "
+            "as JSON to this file after every pass.",
+        )
+        parser.add_argument(
+            "--max-passes",
+            dest="max_passes",
+            action="store",
+            type=int,
+            help="Exit after this many passes through the queue.",
+        )
+        parser.add_argument(
+            "--max-memory",
+            dest="max_memory",
+            action="store",
+            type=int,
+            help="Exit after a pass once the process used this many megabytes "
+            "of memory.",
+        )
+
+    def handle(self, **options):
+        self.options = options
+        self.started = timezone.now()
+        self.passes = 0
+        self.last_success = None
+        self.totals = engine.totals.copy()
+        self.sent = 0
+
+        engine.stopping.clear()
+        handlers = {
+            signum: signal.signal(signum, self.stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            engine.send_loop(
+                send=(
+                    async_engine.send_all
+                    if options["engine"] == "async"
+                    else engine.send_all
+                ),
+                use_locking=options["use_locking"],
+                worker=options["worker"],
+                concurrency=options["concurrency"],
+                after_pass=self.after_pass,
+            )
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        logger.info("Stopped after %s pass(es)." % self.passes)
+
+    def stop(self, signum, frame):
+        logger.info("Received signal %s, stopping after the current message." % signum)
+        engine.stopping.set()
+
+    def after_pass(self):
+        self.passes += 1
+        now = timezone.now()
+        totals = engine.totals - self.totals
+        if totals["sent"] > self.sent:
+            self.last_success = now
+        self.sent = totals["sent"]
+
+        if self.options["heartbeat"]:
+            self.write_heartbeat(now, totals)
+
+        max_passes = self.options["max_passes"]
+        if max_passes is not None and self.passes >= max_passes:
+            engine.stopping.set()
+        max_memory = self.options["max_memory"]
+        if max_memory is not None and memory_used() > max_memory:
+            logger.info("Memory limit (%s MB) reached, stopping." % max_memory)
+            engine.stopping.set()
+
+    def write_heartbeat(self, now, totals):
+        elapsed = (now - self.started).total_seconds()
+        state = {
+            "pid": os.getpid(),
+            "started": self.started.isoformat(),
+            "last_pass": now.isoformat(),
+            "last_success": self.last_success and self.last_success.isoformat(),
+            "passes": self.passes,
+            "sent": totals["sent"],
+            "deferred": totals["deferred"],
+            "skipped": totals["skipped"],
+            "sent_per_second": totals["sent"] / elapsed if elapsed else 0,
+        }
+        # Replace the file at once, so it is never read half written
+        path = self.options["heartbeat"]
+        temporary = "%s.%s.tmp" % (path, os.getpid())
+        try:
+            with open(temporary, "w") as heartbeat:
+                json.dump(state, heartbeat)
+            os.replace(temporary, path)
+        except OSError as err:
+            # Not worth stopping to send mail for
+            logger.warning("Can't write the heartbeat to %s: %s" % (path, err))
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+
+def memory_used():
+    """
+    Peak memory used by this process in megabytes, 0 where unknown.
+    """
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return usage / 1024 / 1024
+    return usage / 1024
@@ -2,7 +2,7 @@ from optparse import make_option
 
 from django.core.management.base import BaseCommand
 
-from mailer.engine import send_all
+from mailer import async_engine, engine
 
 
 class Command(BaseCommand):
@@ -24,6 +24,41 @@ class Command(BaseCommand):
             default=True,
             help="Do not use local mailer lock.",
         )
+        parser.add_argument(
+            "--worker",
+            "-w",
+            dest="worker",
+            action="store_true",
+            default=False,
+            help="Claim messages in batches instead of using the local mailer "
+            "lock, so several workers can send at the same time.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            "-c",
+            dest="concurrency",
+            action="store",
+            type=int,
+            help="The number of threads (or SMTP connections with the async "
+            "engine) delivering mails.",
+        )
+        parser.add_argument(
+            "--engine",
+            "-e",
+            dest="engine",
+            choices=["sync", "async"],
+            default="sync",
+            help="Deliver mails from threads (sync) or from an asyncio event "
+            "loop using aiosmtplib (async).",
+        )
 
     def handle(self, **options):
-        send_all(limit=options["limit"], use_locking=options["use_locking"])
+        send_all = (
+            async_engine.send_all if options["engine"] == "async" else engine.send_all
+        )
+        send_all(
+            limit=options["limit"],
+            use_locking=options["use_locking"],
+            worker=options["worker"],
+            concurrency=options["concurrency"],
+        )
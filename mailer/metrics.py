@@ -0,0 +1,221 @@
+"""
+Counters, gauges and timings of the send pipeline.
+
+Nothing is recorded unless ``MAILER_METRICS`` names a recorder class, e.g.
+``"mailer.metrics.StatsdMetrics"`` or ``"mailer.metrics.PrometheusMetrics"``,
+which is created with the keyword arguments in ``MAILER_METRICS_OPTIONS``.
+"""
+
+import os
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+from logging import getLogger
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = getLogger(__name__)
+
+METRICS = getattr(settings, "MAILER_METRICS", None)
+
+METRICS_OPTIONS = getattr(settings, "MAILER_METRICS_OPTIONS", {})
+
+
+class Metrics(object):
+    """
+    Recorder discarding everything, the base of the others.
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, labels=None):
+        pass
+
+    def gauge(self, name, value, labels=None):
+        pass
+
+    def timing(self, name, seconds, labels=None):
+        pass
+
+    def flush(self):
+        pass
+
+
+class StatsdMetrics(Metrics):
+    """
+    Send every metric to a StatsD server over UDP. Labels become part of the
+    metric name.
+    """
+
+    enabled = True
+
+    def __init__(self, host="localhost", port=8125, prefix="mailer"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def name(self, name, labels):
+        parts = [self.prefix, name] if self.prefix else [name]
+        parts.extend(str(value) for _, value in sorted((labels or {}).items()))
+        return ".".join(parts)
+
+    def send(self, line):
+        try:
+            self.sock.sendto(line.encode("utf-8"), self.address)
+        except socket.error:
+            # Metrics are never worth failing to send mail for
+            pass
+
+    def increment(self, name, value=1, labels=None):
+        self.send("%s:%s|c" % (self.name(name, labels), value))
+
+    def gauge(self, name, value, labels=None):
+        self.send("%s:%s|g" % (self.name(name, labels), value))
+
+    def timing(self, name, seconds, labels=None):
+        self.send("%s:%.3f|ms" % (self.name(name, labels), seconds * 1000))
+
+
+class PrometheusMetrics(Metrics):
+    """
+    Keep the metrics in memory and write them to ``path`` in the Prometheus
+    text format after every pass, for node_exporter's textfile collector.
+    Each process needs a file of its own.
+    """
+
+    enabled = True
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, path, prefix="mailer"):
+        self.path = path
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def increment(self, name, value=1, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def timing(self, name, seconds, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            counts, total, count = self.histograms.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[index] += 1
+            self.histograms[key] = (counts, total + seconds, count + 1)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values, suffix in [
+                ("counter", self.counters, "_total"),
+                ("gauge", self.gauges, ""),
+            ]:
+                for name in sorted(set(name for name, _ in values)):
+                    metric = "%s_%s%s" % (self.prefix, name, suffix)
+                    lines.append("# TYPE %s %s" % (metric, kind))
+                    for (other, labels), value in sorted(values.items()):
+                        if other == name:
+                            lines.append(
+                                "%s%s %s" % (metric, format_labels(labels), value)
+                            )
+            for name in sorted(set(name for name, _ in self.histograms)):
+                metric = "%s_%s_seconds" % (self.prefix, name)
+                lines.append("# TYPE %s histogram" % metric)
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    counts, total, count = histogram
+                    for bound, bucket in zip(self.buckets, counts):
+                        lines.append(
+                            "%s_bucket%s %s"
+                            % (metric, format_labels(labels + (("le", bound),)), bucket)
+                        )
+                    lines.append(
+                        "%s_bucket%s %s"
+                        % (metric, format_labels(labels + (("le", "+Inf"),)), count)
+                    )
+                    lines.append("%s_sum%s %s" % (metric, format_labels(labels), total))
+                    lines.append(
+                        "%s_count%s %s" % (metric, format_labels(labels), count)
+                    )
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        # Replace the file at once, so it is never collected half written
+        temporary = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            with open(temporary, "w") as textfile:
+                textfile.write(self.render())
+            os.replace(temporary, self.path)
+        except OSError as err:
+            # Metrics are never worth failing to send mail for
+            logger.warning("Can't write metrics to %s: %s" % (self.path, err))
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, value) for key, value in labels)
+
+
+def load(path=None, options=None):
+    if not path:
+        return Metrics()
+    return import_string(path)(**(options or {}))
+
+
+recorder = load(METRICS, METRICS_OPTIONS)
+
+
+def enabled():
+    return recorder.enabled
+
+
+def increment(name, value=1, labels=None):
+    recorder.increment(name, value, labels)
+
+
+def gauge(name, value, labels=None):
+    recorder.gauge(name, value, labels)
+
+
+def timing(name, seconds, labels=None):
+    recorder.timing(name, seconds, labels)
+
+
+@contextmanager
+def timer(name, labels=None):
+    """
+    Record how long the block took as a timing.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        recorder.timing(name, time.monotonic() - start, labels)
+
+
+def flush():
+    recorder.flush()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-17 21:17
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0003_auto_20190717_0629"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="claimed_by",
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="lease_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
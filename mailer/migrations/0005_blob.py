@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-17 21:21
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import mailer.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0004_message_lease"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Blob",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sha256", models.CharField(max_length=64, unique=True)),
+                (
+                    "file",
+                    models.FileField(max_length=255, upload_to=mailer.models.blob_path),
+                ),
+                ("size", models.PositiveIntegerField()),
+                ("last_used", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="attachment",
+            name="blob",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                to="mailer.blob",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-17 21:22
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0005_blob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="alternatives",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="headers",
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-17 21:23
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0006_message_headers"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="rendered",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="rendered_messages",
+                to="mailer.blob",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-17 21:25
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0007_message_rendered"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-18 02:40
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0008_message_retry"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="messagelog",
+            name="when_attempted",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-18 02:28
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0009_messagelog_when_attempted"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="dontsendentry",
+            name="to_address",
+            field=models.CharField(db_index=True, max_length=254),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="claimed_by",
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name="messagelog",
+            name="when_attempted",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["priority", "when_added", "id"], name="mailer_message_queue_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["priority", "next_attempt_at"], name="mailer_message_due_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="messagelog",
+            index=models.Index(
+                fields=["when_attempted", "result"], name="mailer_messagelog_age_idx"
+            ),
+        ),
+    ]
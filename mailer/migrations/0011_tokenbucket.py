@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-18 02:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0010_queue_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TokenBucket",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=255, unique=True)),
+                ("tokens", models.FloatField()),
+                ("updated", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-18 02:48
+
+from django.db import migrations
+
+import mailer.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0011_tokenbucket"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="html_body",
+            field=mailer.fields.CompressedTextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="message_body",
+            field=mailer.fields.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name="messagelog",
+            name="html_body",
+            field=mailer.fields.CompressedTextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name="messagelog",
+            name="message_body",
+            field=mailer.fields.CompressedTextField(),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.1.14 on 2026-10-18 02:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+import mailer.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailer", "0012_compressed_bodies"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageContent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("subject", models.CharField(max_length=100)),
+                ("message_body", mailer.fields.CompressedTextField()),
+                ("html_body", mailer.fields.CompressedTextField(blank=True)),
+                ("created", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="context",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="content",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="messages",
+                to="mailer.messagecontent",
+            ),
+        ),
+    ]
@@ -1,11 +1,44 @@
+import hashlib
+import json
+import pathlib
+import random
 import six
-from io import BytesIO
-
-from django.db import models
-from django.core.files.uploadedfile import InMemoryUploadedFile
+import tempfile
+from datetime import timedelta
+from functools import partial
+from string import Template
+
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.core.files.base import ContentFile, File
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
+from django.utils.html import escape
 
 from mailer.enums import PRIORITY_MAPPING, PRIORITIES, RESULT_CODES
+from mailer.fields import CompressedTextField
+from mailer.notify import notify
+from mailer.settings import (
+    MAILER_CHUNK_SIZE,
+    MAILER_LOG_DETAIL,
+    MAILER_RETRY_BACKOFF,
+    MAILER_RETRY_BACKOFF_MAX,
+    MAILER_RETRY_JITTER,
+)
+
+# Times claim() selects messages again after other workers claimed all the
+# ones it selected
+CLAIM_ATTEMPTS = 5
+
+
+def retry_delay(attempts):
+    """
+    How long to wait before retrying a message which failed ``attempts``
+    times: exponential backoff with random jitter.
+    """
+    delay = min(MAILER_RETRY_BACKOFF * 2 ** (attempts - 1), MAILER_RETRY_BACKOFF_MAX)
+    delay *= 1 + random.uniform(-MAILER_RETRY_JITTER, MAILER_RETRY_JITTER)
+    return timedelta(seconds=delay)
 
 
 class MessageManager(models.Manager):
@@ -27,81 +60,507 @@ class MessageManager(models.Manager):
     def deferred(self):
         return self.ready().filter(priority=PRIORITY_MAPPING["deferred"])
 
-    def retry_deferred(self, new_priority=PRIORITY_MAPPING["medium"]):
+    def available(self, now=None):
+        """
+        Non-deferred messages which are not leased by a worker.
+        """
+        now = now or timezone.now()
+        return self.non_deferred().filter(
+            Q(lease_until__isnull=True) | Q(lease_until__lte=now)
+        )
+
+    def claim(self, worker_id, count, lease_seconds):
+        """
+        Lease up to ``count`` of the next messages to send to ``worker_id``
+        and return them in the order they should be sent.
+
+        Claiming is a conditional UPDATE, so concurrent workers never get the
+        same message. Where the database supports it, rows being claimed by
+        another worker are skipped instead of waited for. Elsewhere workers
+        may select the same messages, and the one which lost them all selects
+        again, so an empty result means the queue is empty.
+        """
+        skip_locked = connections[self.db].features.has_select_for_update_skip_locked
+        for _ in range(CLAIM_ATTEMPTS):
+            now = timezone.now()
+            queryset = self.available(now).order_by("priority", "when_added", "id")
+            with transaction.atomic(using=self.db):
+                if skip_locked:
+                    queryset = queryset.select_for_update(skip_locked=True)
+                ids = list(queryset.values_list("id", flat=True)[:count])
+                if not ids:
+                    return []
+                claimed = (
+                    self.available(now)
+                    .filter(pk__in=ids)
+                    .update(
+                        claimed_by=worker_id,
+                        lease_until=now + timedelta(seconds=lease_seconds),
+                    )
+                )
+            if claimed:
+                break
+        return list(
+            self.filter(pk__in=ids, claimed_by=worker_id)
+            .order_by("priority", "when_added", "id")
+            .select_related("rendered")
+            .prefetch_related("attachment_set__blob")
+        )
+
+    def renew(self, worker_id, messages, lease_seconds):
+        """
+        Extend the lease of ``worker_id`` on ``messages`` and return the ids
+        of those it still holds, the others were taken over by another worker.
+        """
+        ids = [message.pk for message in messages]
+        held = self.filter(pk__in=ids, claimed_by=worker_id)
+        renewed = held.update(
+            lease_until=timezone.now() + timedelta(seconds=lease_seconds)
+        )
+        if renewed == len(ids):
+            return set(ids)
+        return set(held.values_list("pk", flat=True))
+
+    def release(self, worker_id):
+        """
+        Give the messages leased by ``worker_id`` back to the queue.
+        """
+        return self.filter(claimed_by=worker_id).update(claimed_by="", lease_until=None)
+
+    def defer_many(self, messages, worker_id=None):
+        """
+        Defer the given messages like Message.defer() does, with one UPDATE.
+        With ``worker_id``, only those still claimed by that worker.
+        """
+        if not messages:
+            return 0
+        now = timezone.now()
+        schedule = []
+        for message in messages:
+            message.priority = PRIORITY_MAPPING["deferred"]
+            message.attempts += 1
+            message.next_attempt_at = now + retry_delay(message.attempts)
+            schedule.append(When(pk=message.pk, then=Value(message.next_attempt_at)))
+        queryset = self.filter(pk__in=[message.pk for message in messages])
+        if worker_id is not None:
+            queryset = queryset.filter(claimed_by=worker_id)
+        return queryset.update(
+            priority=PRIORITY_MAPPING["deferred"],
+            attempts=F("attempts") + 1,
+            next_attempt_at=Case(*schedule, output_field=models.DateTimeField()),
+        )
+
+    def due(self, now=None):
+        """
+        Deferred messages whose next attempt is due.
+        """
+        now = now or timezone.now()
+        return self.deferred().filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+        )
+
+    def retry_deferred(self, new_priority=PRIORITY_MAPPING["medium"], due_only=False):
+        """
+        Put deferred messages (only the due ones with ``due_only``) back on the
+        queue with a single UPDATE, and return how many there were.
+        """
+        queryset = self.due() if due_only else self.deferred()
+        count = queryset.update(priority=new_priority)
+        if count:
+            transaction.on_commit(partial(notify, self.db), using=self.db)
+        return count
+
+
+class MessageContentManager(models.Manager):
+    def collect_garbage(self, grace_period=timedelta(hours=1)):
+        """
+        Delete the content no message refers to anymore, except content
+        created within ``grace_period``.
+        """
+        unreferenced = self.filter(
+            messages__isnull=True, created__lt=timezone.now() - grace_period
+        )
         count = 0
-        for message in self.deferred():
-            if message.retry(new_priority):
-                count += 1
+        for content in unreferenced.iterator():
+            try:
+                with transaction.atomic(using=self.db):
+                    content.delete()
+            except (IntegrityError, models.ProtectedError):
+                # Referenced again since the query
+                continue
+            count += 1
         return count
 
 
+class MessageContent(models.Model):
+    """
+    The subject and bodies of a mass mailing, stored once for all its
+    messages. They may contain ``$name`` variables, replaced by the values in
+    the context of each message when it is sent.
+    """
+
+    objects = MessageContentManager()
+
+    subject = models.CharField(max_length=100)
+    message_body = CompressedTextField()
+    html_body = CompressedTextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.subject
+
+    def render(self, context=None):
+        """
+        Return the subject, plain text and HTML body with the variables in
+        ``context`` substituted, HTML escaped in the HTML body.
+        """
+        if not context:
+            return self.subject, self.message_body, self.html_body
+        escaped = dict((name, escape(value)) for name, value in context.items())
+        return (
+            Template(self.subject).safe_substitute(context),
+            Template(self.message_body).safe_substitute(context),
+            Template(self.html_body).safe_substitute(escaped),
+        )
+
+
 class Message(models.Model):
     objects = MessageManager()
 
     to_address = models.CharField(max_length=254)
     from_address = models.CharField(max_length=254)
     subject = models.CharField(max_length=100)
-    message_body = models.TextField()
+    message_body = CompressedTextField()
     when_added = models.DateTimeField(default=timezone.now)
     priority = models.CharField(
         max_length=1, choices=PRIORITIES, default=PRIORITY_MAPPING["medium"]
     )
-    html_body = models.TextField(blank=True)
+    html_body = CompressedTextField(blank=True)
     ready_to_send = models.BooleanField(default=True, blank=True)
+    claimed_by = models.CharField(max_length=100, blank=True, db_index=True)
+    lease_until = models.DateTimeField(null=True, blank=True)
+    # JSON encoded extra headers and non-HTML alternatives, for messages
+    # queued through the DbBackend
+    headers = models.TextField(blank=True)
+    alternatives = models.TextField(blank=True)
+    # The encoded message, without the To header, when MAILER_PRERENDER is on
+    rendered = models.ForeignKey(
+        "Blob",
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        related_name="rendered_messages",
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    # Content shared with the other messages of a mass mailing, instead of
+    # the subject and bodies of the message, and the JSON encoded variables
+    # to substitute in it
+    content = models.ForeignKey(
+        MessageContent,
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        related_name="messages",
+    )
+    context = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # The queue, in the order prioritize() and claim() read it
+            models.Index(
+                fields=["priority", "when_added", "id"],
+                name="mailer_message_queue_idx",
+            ),
+            # Deferred messages whose next attempt is due
+            models.Index(
+                fields=["priority", "next_attempt_at"], name="mailer_message_due_idx"
+            ),
+        ]
 
     def __str__(self):
         return 'On {0}, "{1}" to {2}'.format(
-            self.when_added, self.subject, self.to_address,
+            self.when_added, self.get_subject(), self.to_address,
+        )
+
+    def get_headers(self):
+        return json.loads(self.headers) if self.headers else {}
+
+    def get_alternatives(self):
+        return json.loads(self.alternatives) if self.alternatives else []
+
+    def get_context(self):
+        return json.loads(self.context) if self.context else {}
+
+    def get_subject(self):
+        """
+        The subject, rendered from the shared content when it wasn't filled in.
+        """
+        if self.subject or self.content_id is None:
+            return self.subject
+        return Template(self.content.subject).safe_substitute(self.get_context())
+
+    def fill_content(self, content):
+        """
+        Take the subject and bodies from the shared ``content``, rendered with
+        the context of this message. Nothing is saved.
+        """
+        self.subject, self.message_body, self.html_body = content.render(
+            self.get_context()
         )
 
     def defer(self):
         self.priority = PRIORITY_MAPPING["deferred"]
-        self.save()
+        self.attempts += 1
+        self.next_attempt_at = timezone.now() + retry_delay(self.attempts)
+        self.save(update_fields=["priority", "attempts", "next_attempt_at"])
 
     def retry(self, new_priority=PRIORITY_MAPPING["medium"]):
         if self.priority == PRIORITY_MAPPING["deferred"]:
             self.priority = new_priority
-            self.save()
+            self.save(update_fields=["priority"])
             return True
         else:
             return False
 
 
-class AttachmentManager(models.Manager):
-    def from_content(self, message, filename, content, mimetype=None):
-        mimetype = mimetype or "application/octet-stream"
-        attachment = self.create(message=message, mimetype=mimetype, filename=filename)
-
-        buffer = BytesIO()
-        buffer.write(content)
-        buffer.seek(2, 0)
-        buffersize = buffer.tell()
-        buffer.seek(0, 0)
+def blob_path(instance, filename):
+    return "attachments/blobs/%s/%s" % (instance.sha256[:2], instance.sha256)
+
+
+def spool(stream):
+    """
+    Copy ``stream`` to a temporary file in chunks, returning the file, the
+    SHA-256 digest and the size of its content.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=MAILER_CHUNK_SIZE)
+    sha256 = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(MAILER_CHUNK_SIZE)
+        if not chunk:
+            break
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode("utf-8")
+        sha256.update(chunk)
+        spooled.write(chunk)
+        size += len(chunk)
+    spooled.seek(0)
+    return spooled, sha256.hexdigest(), size
+
+
+class BlobManager(models.Manager):
+    def from_content(self, content):
+        """
+        Return the blob holding ``content``, storing it if it isn't yet.
 
-        uploaded_file = InMemoryUploadedFile(
-            buffer, "attachment_file", filename, mimetype, buffersize, charset=None
+        ``content`` may be bytes, text, a file-like object or the path of a
+        file; files are stored in chunks rather than read into memory.
+        """
+        if isinstance(content, pathlib.PurePath):
+            # open() only takes Path objects from Python 3.6
+            with open(str(content), "rb") as stream:
+                return self.from_content(stream)
+        if isinstance(content, six.text_type):
+            content = content.encode("utf-8")
+        if isinstance(content, bytes):
+            digest = hashlib.sha256(content).hexdigest()
+            size = len(content)
+            content = ContentFile(content)
+        else:
+            spooled, digest, size = spool(content)
+            content = File(spooled)
+        try:
+            return self._store(content, digest, size)
+        finally:
+            content.close()
+
+    def _store(self, content, digest, size):
+        # Mark an existing blob as used, so it isn't collected while the
+        # attachment referencing it is created
+        if self.filter(sha256=digest).update(last_used=timezone.now()):
+            return self.get(sha256=digest)
+
+        blob = self.model(sha256=digest, size=size)
+        blob.file.save(digest, content, save=False)
+        try:
+            with transaction.atomic(using=self.db):
+                blob.save(using=self.db)
+        except IntegrityError:
+            # Stored by someone else in the meantime
+            blob.file.delete(save=False)
+            return self.get(sha256=digest)
+        return blob
+
+    def collect_garbage(self, grace_period=timedelta(hours=1)):
+        """
+        Delete the blobs not referenced by any attachment or message, and
+        their files. Blobs used within ``grace_period`` are kept.
+        """
+        unreferenced = self.filter(
+            attachment__isnull=True,
+            rendered_messages__isnull=True,
+            last_used__lt=timezone.now() - grace_period,
         )
-        attachment.attachment_file.save(filename, uploaded_file)
+        count = 0
+        for blob in unreferenced.iterator():
+            try:
+                with transaction.atomic(using=self.db):
+                    # Only if not used or referenced again since the query
+                    deleted, _ = unreferenced.filter(pk=blob.pk).delete()
+            except (IntegrityError, models.ProtectedError):
+                continue
+            if not deleted:
+                continue
+            blob.file.delete(save=False)
+            count += 1
+        return count
+
+
+class Blob(models.Model):
+    """
+    Attachment or pre-rendered message content, stored once however many
+    attachments or messages share it.
+    """
 
-        buffer.close()
+    objects = BlobManager()
 
-        attachment.save()
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=blob_path, max_length=255)
+    size = models.PositiveIntegerField()
+    last_used = models.DateTimeField(default=timezone.now)
 
-        return attachment
+    def __str__(self):
+        return self.sha256
+
+    def read(self):
+        self.file.open("rb")
+        try:
+            return self.file.read()
+        finally:
+            self.file.close()
+
+
+class AttachmentManager(models.Manager):
+    def from_content(self, message, filename, content, mimetype=None):
+        mimetype = mimetype or "application/octet-stream"
+        return self.create(
+            message=message,
+            mimetype=mimetype,
+            filename=filename,
+            blob=Blob.objects.from_content(content),
+        )
+
+    def bulk_attach(self, messages, attachments, batch_size=None):
+        """
+        Attach each of the (filename, content, mimetype) ``attachments`` to all
+        of the saved ``messages``. The content may be a stored Blob already.
+        """
+        rows = []
+        for filename, content, mimetype in attachments:
+            blob = content
+            if not isinstance(blob, Blob):
+                blob = Blob.objects.from_content(content)
+            rows.extend(
+                self.model(
+                    message=message,
+                    mimetype=mimetype or "application/octet-stream",
+                    filename=filename,
+                    blob=blob,
+                )
+                for message in messages
+            )
+        return self.bulk_create(rows, batch_size)
 
 
 class Attachment(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE)
+    # Attachments added before blobs existed have their own file
     attachment_file = models.FileField(
         "attachment file", upload_to="attachments/", blank=True
     )
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT)
     filename = models.CharField(max_length=255)
     mimetype = models.CharField(max_length=255, blank=True)
 
     objects = AttachmentManager()
 
     def __str__(self):
-        return self.attachment_file.name
+        return self.file.name
+
+    @property
+    def file(self):
+        return self.blob.file if self.blob_id else self.attachment_file
+
+    @property
+    def size(self):
+        return self.blob.size if self.blob_id else self.attachment_file.size
+
+    def read(self):
+        self.file.open("rb")
+        try:
+            return self.file.read()
+        finally:
+            self.file.close()
+
+    def chunks(self, chunk_size=MAILER_CHUNK_SIZE):
+        """
+        Yield the content in chunks, from a file of its own so attachments
+        sharing a blob can be read at the same time.
+        """
+        stream = self.file.storage.open(self.file.name, "rb")
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            stream.close()
+
+
+class TokenBucketManager(models.Manager):
+    def acquire(self, limits, now):
+        """
+        Lock the buckets in ``limits``, a dict of key to (count, seconds),
+        and return the tokens each of them holds at ``now``. Buckets are
+        created full. Must be called in a transaction, followed by store().
+        """
+        buckets = self.select_for_update().filter(key__in=limits).order_by("key")
+        found = dict((bucket.key, bucket) for bucket in buckets)
+        for key in sorted(set(limits) - set(found)):
+            found[key], _ = self.select_for_update().get_or_create(
+                key=key, defaults={"tokens": limits[key][0], "updated": now}
+            )
+
+        tokens = {}
+        for key, (count, seconds) in limits.items():
+            bucket = found[key]
+            elapsed = max((now - bucket.updated).total_seconds(), 0)
+            tokens[key] = min(count, bucket.tokens + elapsed * count / seconds)
+        return tokens
+
+    def store(self, tokens, now):
+        """
+        Save the tokens left in the buckets returned by acquire() at ``now``.
+        """
+        for key, left in tokens.items():
+            self.filter(key=key).update(tokens=left, updated=now)
+
+
+class TokenBucket(models.Model):
+    """
+    Rate limit state shared by all workers, see mailer.throttle.
+    """
+
+    objects = TokenBucketManager()
+
+    key = models.CharField(max_length=255, unique=True)
+    tokens = models.FloatField()
+    updated = models.DateTimeField()
+
+    def __str__(self):
+        return self.key
 
 
 class DontSendEntryManager(models.Manager):
@@ -118,7 +577,7 @@ class DontSendEntryManager(models.Manager):
 class DontSendEntry(models.Model):
     objects = DontSendEntryManager()
 
-    to_address = models.CharField(max_length=254)
+    to_address = models.CharField(max_length=254, db_index=True)
     when_added = models.DateTimeField()
 
     class Meta:
@@ -135,29 +594,64 @@ class MessageLogManager(models.Manager):
         create a log entry for an attempt to send the given message and
         record the given result and (optionally) a log message
         """
+        message_log = self.build(message, result_code, log_message)
+        message_log.save()
+        return message_log
 
+    def build(self, message, result_code, log_message=""):
+        """
+        return an unsaved log entry for the given message, keeping as much of
+        its content as MAILER_LOG_DETAIL asks for
+        """
         attachments_info = "\n".join(
             "%s: %s" % (attachment.filename, six.text_type(attachment))
             for attachment in message.attachment_set.all()
         )
-        message_body = (
-            "%s\n\nAttachments:\n%s" % (message.message_body, attachments_info)
-            if attachments_info
-            else message.message_body
-        )
+        if MAILER_LOG_DETAIL == "full":
+            message_body, html_body = message.message_body, message.html_body
+        elif MAILER_LOG_DETAIL == "hash":
+            digest = hashlib.sha256(message.message_body.encode("utf-8"))
+            digest.update(message.html_body.encode("utf-8"))
+            message_body, html_body = "sha256:%s" % digest.hexdigest(), ""
+        else:
+            message_body, html_body = "", ""
+        if attachments_info:
+            message_body = "%s\n\nAttachments:\n%s" % (message_body, attachments_info)
 
-        message_log = self.create(
+        return self.model(
             to_address=message.to_address,
             from_address=message.from_address,
-            subject=message.subject,
+            # Variables may have made it longer than a subject can be stored
+            subject=message.subject[:100],
             message_body=message_body,
             when_added=message.when_added,
             priority=message.priority,
-            html_body=message.html_body,
+            html_body=html_body,
             result=result_code,
             log_message=log_message,
         )
-        message_log.save()
+
+    def purge(self, before, results=None, chunk_size=1000, archive=None):
+        """
+        Delete the log entries attempted before ``before`` (only those with
+        one of the given ``results``), ``chunk_size`` rows per transaction so
+        no lock is held for long. With ``archive``, a file-like object, the
+        rows are written to it as JSON lines first.
+        """
+        queryset = self.filter(when_attempted__lt=before)
+        if results is not None:
+            queryset = queryset.filter(result__in=results)
+        count = 0
+        while True:
+            with transaction.atomic(using=self.db):
+                rows = list(queryset.order_by("when_attempted").values()[:chunk_size])
+                if not rows:
+                    return count
+                if archive is not None:
+                    for row in rows:
+                        archive.write(json.dumps(row, cls=DjangoJSONEncoder) + "\n")
+                self.filter(pk__in=[row["id"] for row in rows]).delete()
+            count += len(rows)
 
 
 class MessageLog(models.Model):
@@ -166,15 +660,22 @@ class MessageLog(models.Model):
     to_address = models.CharField(max_length=254, db_index=True)
     from_address = models.CharField(max_length=254)
     subject = models.CharField(max_length=100)
-    message_body = models.TextField()
+    message_body = CompressedTextField()
     when_added = models.DateTimeField()
     priority = models.CharField(max_length=1, choices=PRIORITIES)
-    html_body = models.TextField(blank=True)
+    html_body = CompressedTextField(blank=True)
 
     when_attempted = models.DateTimeField(default=timezone.now)
     result = models.CharField(max_length=1, choices=RESULT_CODES)
     log_message = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["when_attempted", "result"], name="mailer_messagelog_age_idx"
+            ),
+        ]
+
     def __str__(self):
         return 'On {0}, "{1}" to {2}'.format(
             self.when_attempted, self.subject, self.to_address
@@ -0,0 +1,218 @@
+"""
+Wake a waiting ``send_loop`` as soon as mail is put on the queue.
+
+On PostgreSQL this uses LISTEN/NOTIFY, so workers on any host are woken.
+Elsewhere every local loop listens on a UNIX socket of its own in a shared
+directory, and a datagram is sent to each of them.
+Notifications are a shortcut only: the loop still checks the queue every
+``MAILER_EMPTY_QUEUE_SLEEP`` seconds in case one gets lost.
+"""
+
+import os
+import select
+import socket
+import time
+import uuid
+
+from logging import getLogger
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = getLogger(__name__)
+
+# Set to False to never notify, leaving send_loop to poll
+ENABLED = getattr(settings, "MAILER_NOTIFY", True)
+
+# PostgreSQL channel used with LISTEN/NOTIFY
+CHANNEL = getattr(settings, "MAILER_NOTIFY_CHANNEL", "mailer_queue")
+
+# Directory of the UNIX sockets used on other databases, like the lock file
+# relative to the working directory unless absolute
+SOCKET_DIR = getattr(settings, "MAILER_NOTIFY_SOCKET_DIR", "send_mail.sockets")
+
+
+def uses_listen(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == "postgresql"
+
+
+def notify(using=DEFAULT_DB_ALIAS):
+    """
+    Tell the listening send loops there is mail on the queue.
+    """
+    if not ENABLED:
+        return
+    if uses_listen(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("NOTIFY %s" % CHANNEL)
+        return
+    if not hasattr(socket, "AF_UNIX"):
+        return
+    try:
+        names = os.listdir(SOCKET_DIR)
+    except OSError:
+        # No loop ever listened
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        for name in names:
+            if not name.endswith(".sock"):
+                continue
+            path = os.path.join(SOCKET_DIR, name)
+            try:
+                sock.sendto(b"1", path)
+            except ConnectionRefusedError:
+                # Left behind by a loop which didn't stop cleanly
+                _unlink(path)
+            except (OSError, socket.error):
+                # Gone meanwhile, or the listener has enough wake ups pending
+                pass
+    finally:
+        sock.close()
+
+
+def listen(using=DEFAULT_DB_ALIAS):
+    """
+    Return a listener whose ``wait(timeout)`` returns early when notified.
+    """
+    if not ENABLED:
+        return Listener()
+    if uses_listen(using):
+        return PostgresListener(using)
+    if hasattr(socket, "AF_UNIX"):
+        try:
+            return SocketListener(SOCKET_DIR)
+        except (OSError, socket.error) as err:
+            logger.warning("Can't listen in %s: %s" % (SOCKET_DIR, err))
+    return Listener()
+
+
+class Listener(object):
+    """
+    Never notified, waiting is sleeping.
+    """
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class SocketListener(Listener):
+    """
+    Listen on a socket of this process in ``directory``, so any number of
+    loops on the host are all notified.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(
+            directory, "%s-%s.sock" % (os.getpid(), uuid.uuid4().hex[:8])
+        )
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(self.path)
+            self.inode = os.stat(self.path).st_ino
+        except (OSError, socket.error):
+            self.sock.close()
+            raise
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+        # Notifications received while sending are all handled by one pass
+        self.sock.setblocking(False)
+        try:
+            while True:
+                self.sock.recv(16)
+        except (OSError, socket.error):
+            pass
+        finally:
+            self.sock.setblocking(True)
+        return True
+
+    def close(self):
+        self.sock.close()
+        try:
+            if os.stat(self.path).st_ino != self.inode:
+                # Not our socket anymore
+                return
+        except OSError:
+            return
+        _unlink(self.path)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class PostgresListener(Listener):
+    """
+    LISTEN on a connection of its own, so it stays subscribed however the
+    connection used for sending is opened and closed. When that connection
+    is lost, e.g. on a database restart, it listens again on a new one.
+    """
+
+    def __init__(self, using):
+        self.wrapper = connections[using]
+        self.connection = None
+        try:
+            self.connect()
+        except self.wrapper.Database.Error as err:
+            # Tried again when waiting
+            logger.warning("Can't listen for mail: %s" % err)
+
+    def connect(self):
+        connection = self.wrapper.get_new_connection(
+            self.wrapper.get_connection_params()
+        )
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("LISTEN %s" % CHANNEL)
+        self.connection = connection
+
+    def wait(self, timeout):
+        if self.connection is None:
+            return self.reconnect(timeout)
+        try:
+            if not self.connection.notifies:
+                readable, _, _ = select.select([self.connection], [], [], timeout)
+                if readable:
+                    self.connection.poll()
+        except (self.wrapper.Database.Error, OSError, ValueError) as err:
+            logger.warning("Lost the connection listening for mail: %s" % err)
+            self.close()
+            return self.reconnect(timeout)
+        notified = bool(self.connection.notifies)
+        del self.connection.notifies[:]
+        return notified
+
+    def reconnect(self, timeout):
+        """
+        Listen on a new connection, or sleep like Listener when the database
+        can't be reached. Notifications may have been missed meanwhile, so
+        listening again counts as being notified.
+        """
+        try:
+            self.connect()
+        except self.wrapper.Database.Error as err:
+            logger.warning("Can't listen for mail: %s" % err)
+            time.sleep(timeout)
+            return False
+        return True
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except self.wrapper.Database.Error:
+                pass
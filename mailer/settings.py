@@ -10,3 +10,34 @@ Example:
 
 """
 MAILER_EXTRA_HEADERS = getattr(settings, "MAILER_EXTRA_HEADERS", None)
+
+# Number of messages inserted per query when putting mail on the queue
+MAILER_ENQUEUE_BATCH_SIZE = getattr(settings, "MAILER_ENQUEUE_BATCH_SIZE", 500)
+
+# Render the MIME message once when putting mail on the queue, instead of for
+# every recipient when sending it
+MAILER_PRERENDER = getattr(settings, "MAILER_PRERENDER", False)
+
+# Deferred messages are retried after MAILER_RETRY_BACKOFF seconds, doubling
+# with every failed attempt up to MAILER_RETRY_BACKOFF_MAX, and randomly
+# spread by MAILER_RETRY_JITTER (a fraction of the delay) either way
+MAILER_RETRY_BACKOFF = getattr(settings, "MAILER_RETRY_BACKOFF", 60)
+MAILER_RETRY_BACKOFF_MAX = getattr(settings, "MAILER_RETRY_BACKOFF_MAX", 6 * 60 * 60)
+MAILER_RETRY_JITTER = getattr(settings, "MAILER_RETRY_JITTER", 0.2)
+
+# How much of a message to keep in its log entries: "full" copies the bodies,
+# "hash" keeps a SHA-256 digest of them and "headers" none of them
+MAILER_LOG_DETAIL = getattr(settings, "MAILER_LOG_DETAIL", "full")
+
+# Attachment files are read and written in chunks of this many bytes, and
+# attachments larger than MAILER_STREAM_ATTACHMENTS_SIZE are streamed to the
+# SMTP server rather than read into memory
+MAILER_CHUNK_SIZE = getattr(settings, "MAILER_CHUNK_SIZE", 64 * 1024)
+MAILER_STREAM_ATTACHMENTS_SIZE = getattr(
+    settings, "MAILER_STREAM_ATTACHMENTS_SIZE", 1024 * 1024
+)
+
+# Compress message bodies of MAILER_COMPRESS_MIN_SIZE characters or more in the
+# database with "zlib" or "zstd" (which needs the zstandard package)
+MAILER_COMPRESS_BODIES = getattr(settings, "MAILER_COMPRESS_BODIES", None)
+MAILER_COMPRESS_MIN_SIZE = getattr(settings, "MAILER_COMPRESS_MIN_SIZE", 1024)
@@ -0,0 +1,144 @@
+"""
+Sending emails with large attachments without reading them into memory.
+
+Such attachments are rendered as a placeholder, and their base64 encoding is
+streamed into the SMTP DATA command chunk by chunk when the email is sent.
+"""
+import base64
+import re
+import smtplib
+import uuid
+
+from email.mime.base import MIMEBase
+
+from mailer.settings import MAILER_CHUNK_SIZE
+
+# Base64 lines of 76 characters encode 57 bytes each
+LINE_BYTES = 57
+
+
+class AttachmentPart(MIMEBase):
+    """
+    MIME part for an Attachment, whose content is only read when the part is
+    streamed or loaded.
+    """
+
+    def __init__(self, attachment):
+        mimetype = attachment.mimetype or "application/octet-stream"
+        maintype, _, subtype = mimetype.partition("/")
+        MIMEBase.__init__(self, maintype, subtype or "octet-stream")
+        self.attachment = attachment
+        self.loaded = False
+        token = "mailer-attachment-%s" % uuid.uuid4().hex
+        self.placeholder = base64.b64encode(token.encode("ascii"))
+        self.set_payload(self.placeholder.decode("ascii"))
+        self["Content-Transfer-Encoding"] = "base64"
+        filename = attachment.filename
+        if filename:
+            try:
+                filename.encode("ascii")
+            except UnicodeEncodeError:
+                filename = ("utf-8", "", filename)
+            self.add_header("Content-Disposition", "attachment", filename=filename)
+
+    def load(self):
+        """
+        Replace the placeholder with the content, for backends which need the
+        whole message.
+        """
+        self.set_payload(base64.encodebytes(self.attachment.read()).decode("ascii"))
+        self.loaded = True
+
+    def encoded_chunks(self):
+        """
+        Yield the base64 encoded content in lines ending with CRLF.
+        """
+        chunk_size = max(MAILER_CHUNK_SIZE // LINE_BYTES, 1) * LINE_BYTES
+        pending = b""
+        for chunk in self.attachment.chunks(chunk_size):
+            pending += chunk
+            # Only whole lines, the storage may return less than asked for
+            whole = len(pending) - len(pending) % LINE_BYTES
+            if whole:
+                yield base64.encodebytes(pending[:whole]).replace(b"\n", b"\r\n")
+                pending = pending[whole:]
+        if pending:
+            yield base64.encodebytes(pending).replace(b"\n", b"\r\n")
+
+
+def streamed_parts(email):
+    return [
+        part
+        for part in getattr(email, "attachments", [])
+        if isinstance(part, AttachmentPart) and not part.loaded
+    ]
+
+
+def message_chunks(email):
+    """
+    Yield the email as it is sent over SMTP, with the content of its streamed
+    attachments read in chunks.
+    """
+    data = email.message().as_bytes(linesep="\r\n")
+    for part in streamed_parts(email):
+        head, found, data = data.partition(part.placeholder + b"\r\n")
+        if not found:
+            raise ValueError("Attachment %s is missing from the message" % part)
+        yield head
+        for chunk in part.encoded_chunks():
+            yield chunk
+    yield data
+
+
+def sendmail(smtp, from_addr, to_addrs, chunks):
+    """
+    Send the message in ``chunks`` over the ``smtplib.SMTP`` connection like
+    its sendmail() does, returning the refused recipients.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(from_addr)
+    if code != 250:
+        _abort(smtp, code)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for address in to_addrs:
+        code, resp = smtp.rcpt(address)
+        if code not in (250, 251):
+            refused[address] = (code, resp)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        _abort(smtp, code)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, resp = smtp.docmd("data")
+    if code != 354:
+        _abort(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    line_start = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        # Lines starting with a period get another one, as in smtplib
+        chunk = re.sub(rb"(?<=\n)\.", b"..", chunk)
+        if line_start and chunk.startswith(b"."):
+            chunk = b"." + chunk
+        smtp.send(chunk)
+        line_start = chunk.endswith(b"\n")
+    smtp.send(b".\r\n" if line_start else b"\r\n.\r\n")
+    code, resp = smtp.getreply()
+    if code != 250:
+        _abort(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _abort(smtp, code):
+    if code == 421:
+        smtp.close()
+        return
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
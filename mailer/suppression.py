@@ -0,0 +1,121 @@
+import hashlib
+import math
+import re
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from mailer.models import DontSendEntry
+
+
+# Above this many entries the don't send list is kept as a Bloom filter
+# instead of a set, and matches are confirmed against the database
+BLOOM_THRESHOLD = getattr(settings, "MAILER_DONT_SEND_BLOOM_THRESHOLD", 1000000)
+
+# Seconds between checks whether the don't send list changed
+REFRESH_INTERVAL = getattr(settings, "MAILER_DONT_SEND_REFRESH_INTERVAL", 10)
+
+
+class BloomFilter(object):
+    """
+    Set membership with false positives, in a fraction of the memory of a set.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.sha1(value.encode("utf-8")).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:16], "little")
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+class DontSendIndex(object):
+    """
+    In-process copy of the don't send list, reloaded when it changed.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.checked = None
+        self.addresses = set()
+        self.exact = True
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self.checked and now - self.checked < REFRESH_INTERVAL:
+            return
+        self.checked = now
+
+        version = DontSendEntry.objects.aggregate(
+            count=Count("id"), last=Max("id"), when=Max("when_added")
+        )
+        version = (version["count"], version["last"], version["when"])
+        if version == self.version:
+            return
+
+        addresses = DontSendEntry.objects.values_list("to_address", flat=True)
+        if version[0] > BLOOM_THRESHOLD:
+            self.addresses = BloomFilter(version[0])
+            for address in addresses.iterator():
+                self.addresses.add(address)
+            self.exact = False
+        else:
+            self.addresses = set(addresses)
+            self.exact = True
+        self.version = version
+
+    def filter(self, addresses):
+        """
+        Return the set of the given addresses which are on the list.
+        """
+        found = set(address for address in addresses if address in self.addresses)
+        if found and not self.exact:
+            found = set(
+                DontSendEntry.objects.filter(to_address__in=found).values_list(
+                    "to_address", flat=True
+                )
+            )
+        return found
+
+
+def combine_patterns(patterns):
+    """
+    Combine regular expressions into as few as possible, one per set of flags.
+    Patterns with groups, whose names and numbers would clash, are kept as
+    they are, like those which can't be combined.
+    """
+    combined, groups = [], {}
+    for pattern in patterns:
+        if not hasattr(pattern, "search"):
+            pattern = re.compile(pattern)
+        if pattern.groups:
+            combined.append(pattern)
+        else:
+            groups.setdefault(pattern.flags, []).append(pattern)
+    for flags, group in groups.items():
+        try:
+            combined.append(
+                re.compile(
+                    "|".join("(?:%s)" % pattern.pattern for pattern in group), flags
+                )
+            )
+        except re.error:
+            # E.g. inline flags, only allowed at the start of a pattern
+            combined.extend(group)
+    return combined
@@ -1,23 +1,61 @@
 # coding: utf-8
+import asyncio
+import email
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import re
+import shutil
 import smtplib
+import socket
+import tempfile
+import time
 import mock
 
+from datetime import timedelta
+
+from unittest import skipIf
+
+from django.conf import settings
 from django.core import mail
 from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.db.models.query import QuerySet
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 import mailer
-from mailer import lockfile
-from mailer import engine, send_mail
+from mailer import fields, lockfile, notify
+from mailer import async_engine, engine, send_mail, streaming
+from mailer.async_engine import aiosmtplib
+from mailer.connection import Relay
 from mailer.enums import (
+    RESULT_MAPPING,
     PRIORITY_LOW,
     PRIORITY_MEDIUM,
     PRIORITY_HIGH,
     PRIORITY_DEFERRED,
 )
 from mailer.engine import send_all
-from mailer.models import DontSendEntry, Message, MessageLog
+from mailer.metrics import PrometheusMetrics, StatsdMetrics
+from mailer.models import (
+    Attachment,
+    Blob,
+    DontSendEntry,
+    Message,
+    MessageContent,
+    MessageLog,
+    TokenBucket,
+    retry_delay,
+)
+from mailer.suppression import BloomFilter, DontSendIndex, combine_patterns
+from mailer.throttle import RateLimiter, parse_rates
 
 
 class FailingMailerEmailBackend(LocMemEmailBackend):
@@ -25,6 +63,105 @@ class FailingMailerEmailBackend(LocMemEmailBackend):
         raise smtplib.SMTPSenderRefused(1, "foo", "foo@foo.com")
 
 
+class CountingEmailBackend(LocMemEmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+class DisconnectingEmailBackend(CountingEmailBackend):
+    def send_messages(self, email_messages):
+        if CountingEmailBackend.opened == 1:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        return super(DisconnectingEmailBackend, self).send_messages(email_messages)
+
+
+class RelayEmailBackend(LocMemEmailBackend):
+    def __init__(self, host=None, **kwargs):
+        super(RelayEmailBackend, self).__init__(**kwargs)
+        self.host = host
+
+    def send_messages(self, email_messages):
+        if self.host == "down":
+            raise smtplib.SMTPConnectError(421, "Service not available")
+        for email in email_messages:
+            if email.to == ["refused@example.com"]:
+                raise smtplib.SMTPRecipientsRefused({})
+            email.extra_headers["X-Relay"] = self.host
+        return super(RelayEmailBackend, self).send_messages(email_messages)
+
+
+class SlowEmailBackend(LocMemEmailBackend):
+    def send_messages(self, email_messages):
+        time.sleep(0.6)
+        return super(SlowEmailBackend, self).send_messages(email_messages)
+
+
+class TakenOverEmailBackend(LocMemEmailBackend):
+    def send_messages(self, email_messages):
+        # Another worker claims the messages while they are sent
+        Message.objects.update(claimed_by="other")
+        return super(TakenOverEmailBackend, self).send_messages(email_messages)
+
+
+class StoppingEmailBackend(LocMemEmailBackend):
+    def send_messages(self, email_messages):
+        engine.stopping.set()
+        return super(StoppingEmailBackend, self).send_messages(email_messages)
+
+
+class FakeSMTP(smtplib.SMTP):
+    """
+    Records the transactions instead of talking to a server, refusing
+    recipients whose address starts with "refused".
+    """
+
+    sent = []
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, sender, options=()):
+        self.transaction = (sender, [], [])
+        return 250, b"OK"
+
+    def rcpt(self, recip, options=()):
+        self.transaction[1].append(recip)
+        if recip.startswith("refused"):
+            return 550, b"No such user"
+        return 250, b"OK"
+
+    def rset(self):
+        return 250, b"OK"
+
+    def putcmd(self, cmd, args=""):
+        self.data_command = cmd.lower() == "data"
+
+    def send(self, s):
+        self.transaction[2].append(s)
+
+    def getreply(self):
+        if self.data_command:
+            self.data_command = False
+            return 354, b"Go ahead"
+        sender, recipients, chunks = self.transaction
+        FakeSMTP.sent.append((sender, recipients, b"".join(chunks)))
+        return 250, b"OK"
+
+
+class FakeSMTPEmailBackend(SMTPEmailBackend):
+    def open(self):
+        if self.connection:
+            return False
+        self.connection = FakeSMTP()
+        return True
+
+    def close(self):
+        self.connection = None
+
+
 class BasicTestCase(TestCase):
     def test_save_to_db(self):
         """
@@ -75,6 +212,100 @@ class SendingTest(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(Message.objects.count(), 0)
 
+    def test_bad_header_deferred(self):
+        for subject in ["First", "bad\nsubject", "Third"]:
+            send_mail(subject, "Body", "sender@example.com", ["r@example.com"])
+
+        send_all()
+        self.assertEqual([email.subject for email in mail.outbox], ["First", "Third"])
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(Message.objects.count(), 1)
+
+        # The others aren't sent again
+        send_all()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_retry_backoff(self):
+        with self.settings(EMAIL_BACKEND="mailer.tests.FailingMailerEmailBackend"):
+            send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+            with mock.patch("mailer.models.MAILER_RETRY_JITTER", 0):
+                send_all()
+                message = Message.objects.get()
+                self.assertEqual(message.attempts, 1)
+                delay = message.next_attempt_at - timezone.now()
+                self.assertTrue(timedelta(seconds=55) < delay <= timedelta(seconds=60))
+
+                # Not due yet
+                with self.assertNumQueries(1):
+                    self.assertEqual(Message.objects.retry_deferred(due_only=True), 0)
+
+                Message.objects.update(next_attempt_at=timezone.now())
+                self.assertEqual(Message.objects.retry_deferred(due_only=True), 1)
+                send_all()
+                message = Message.objects.get()
+                self.assertEqual(message.attempts, 2)
+                delay = message.next_attempt_at - timezone.now()
+                self.assertTrue(
+                    timedelta(seconds=115) < delay <= timedelta(seconds=120)
+                )
+
+        call_command("retry_deferred")
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        call_command("retry_deferred", "--all")
+        self.assertEqual(Message.objects.deferred().count(), 0)
+
+    def test_retry_delay(self):
+        with mock.patch("mailer.models.MAILER_RETRY_BACKOFF_MAX", 600):
+            self.assertLessEqual(retry_delay(30), timedelta(seconds=720))
+
+    def test_log_written_per_batch(self):
+        DontSendEntry.objects.create(
+            to_address="nogo@example.com", when_added=timezone.now()
+        )
+        for address in ["a@example.com", "b@example.com", "nogo@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+
+        with CaptureQueriesContext(connection) as queries:
+            engine.send_all()
+        inserts = [
+            query
+            for query in queries.captured_queries
+            if query["sql"].startswith('INSERT INTO "mailer_messagelog"')
+        ]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(MessageLog.objects.count(), 3)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.RelayEmailBackend")
+    def test_outcomes_written_per_batch(self):
+        for address in ["a@example.com", "b@example.com", "c@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+        for i in range(2):
+            send_mail("Subject", "Body", "sender@example.com", ["refused@example.com"])
+
+        with CaptureQueriesContext(connection) as queries:
+            engine.send_all()
+        statements = [
+            query["sql"].split(" SET ")[0].split(" WHERE ")[0] for query in queries
+        ]
+        self.assertEqual(statements.count('UPDATE "mailer_message"'), 1)
+        self.assertEqual(statements.count('DELETE FROM "mailer_message"'), 1)
+        self.assertEqual(len(mail.outbox), 3)
+        deferred = Message.objects.deferred()
+        self.assertEqual(deferred.count(), 2)
+        self.assertFalse(deferred.filter(next_attempt_at__isnull=True).exists())
+        self.assertEqual(set(deferred.values_list("attempts", flat=True)), {1})
+
+    def test_log_detail(self):
+        send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+        message = Message.objects.get()
+        with mock.patch("mailer.models.MAILER_LOG_DETAIL", "headers"):
+            log = MessageLog.objects.build(message, RESULT_MAPPING["success"])
+            self.assertEqual((log.message_body, log.html_body), ("", ""))
+            self.assertEqual(log.subject, "Subject")
+        with mock.patch("mailer.models.MAILER_LOG_DETAIL", "hash"):
+            log = MessageLog.objects.build(message, RESULT_MAPPING["success"])
+            self.assertTrue(log.message_body.startswith("sha256:"))
+
     def test_mail_admins(self):
         with self.settings(ADMINS=(("Test", "testadmin@example.com"),)):  # noqa
             mailer.mail_admins("Subject", "Admin Body")
@@ -143,6 +374,1285 @@ class SendingTest(TestCase):
             self.assertEqual(sent.to, ["go@example.com"])
 
 
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class AttachmentTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        patcher = override_settings(MEDIA_ROOT=media_root)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def test_bulk_enqueue(self):
+        recipients = ["r%s@example.com" % i for i in range(10)]
+        attachments = [
+            ("file.txt", b"attachment", "text/plain"),
+            ("file.pdf", b"%PDF-1.4", None),
+        ]
+
+        with mock.patch("mailer.settings.MAILER_ENQUEUE_BATCH_SIZE", 4):
+            send_mail(
+                "Subject",
+                "Body",
+                "sender@example.com",
+                recipients,
+                attachments=attachments,
+            )
+
+        self.assertEqual(Message.objects.ready().count(), 10)
+        self.assertEqual(Attachment.objects.count(), 20)
+        # One file per distinct attachment, not per recipient
+        self.assertEqual(Blob.objects.count(), 2)
+
+        send_all()
+
+        self.assertEqual(len(mail.outbox), 10)
+        self.assertEqual(
+            mail.outbox[0].attachments,
+            [
+                ("file.txt", "attachment", "text/plain"),
+                ("file.pdf", b"%PDF-1.4", "application/octet-stream"),
+            ],
+        )
+
+    def test_bulk_enqueue_queries(self):
+        recipients = ["r%s@example.com" % i for i in range(20)]
+
+        with mock.patch("mailer.settings.MAILER_ENQUEUE_BATCH_SIZE", 10):
+            # Savepoint, the shared content, two inserts and the release
+            with self.assertNumQueries(5):
+                send_mail("Subject", "Body", "sender@example.com", recipients)
+
+        self.assertEqual(Message.objects.ready().count(), 20)
+
+    def test_missing_file_deferred(self):
+        for address in ["a@example.com", "b@example.com"]:
+            send_mail(
+                "Subject",
+                "Body",
+                "sender@example.com",
+                [address],
+                attachments=[(address, address.encode("ascii"), "text/plain")],
+            )
+        blob = Attachment.objects.get(message__to_address="a@example.com").blob
+        blob.file.storage.delete(blob.file.name)
+
+        send_all()
+        self.assertEqual([email.to for email in mail.outbox], [["b@example.com"]])
+        self.assertEqual(Message.objects.deferred().get().to_address, "a@example.com")
+        self.assertEqual(
+            MessageLog.objects.get(to_address="a@example.com").result,
+            RESULT_MAPPING["failure"],
+        )
+
+    @mock.patch("mailer.settings.MAILER_PRERENDER", True)
+    def test_prerendered(self):
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com", "b@example.com"],
+            html_body="<p>Body</p>",
+            attachments=[("file.txt", b"attachment", "text/plain")],
+        )
+
+        # The attachment and the message rendered once for both recipients
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertEqual(Message.objects.values("rendered").distinct().count(), 1)
+
+        with mock.patch.object(Attachment, "read", side_effect=AssertionError):
+            send_all()
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, ["a@example.com"])
+        data = mail.outbox[0].message().as_bytes()
+        self.assertTrue(data.startswith(b"To: a@example.com\nDate: "))
+        self.assertIn(b"Subject: Subject\n", data)
+        self.assertIn(b"<p>Body</p>", data)
+        self.assertIn(b'filename="file.txt"', data)
+        self.assertTrue(
+            mail.outbox[1].message().as_bytes().startswith(b"To: b@example.com\n")
+        )
+        # Headers of every recipient's own, readable like any other message
+        first, second = [sent.message() for sent in mail.outbox]
+        self.assertNotEqual(first["Message-ID"], second["Message-ID"])
+        self.assertEqual(len(first.get_all("Message-ID")), 1)
+        self.assertEqual(len(first.get_all("Date")), 1)
+        self.assertEqual(first["Subject"], "Subject")
+        self.assertEqual(MessageLog.objects.count(), 2)
+
+        self.assertEqual(Blob.objects.collect_garbage(grace_period=timedelta(0)), 2)
+
+    def test_deduplicated_storage(self):
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com"],
+            attachments=[("a.txt", b"same", "text/plain")],
+        )
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["b@example.com"],
+            attachments=[("b.txt", b"same", "text/plain")],
+        )
+
+        self.assertEqual(Attachment.objects.count(), 2)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.size, 4)
+        self.assertEqual(
+            set(Attachment.objects.values_list("filename", flat=True)),
+            {"a.txt", "b.txt"},
+        )
+
+        # Still referenced by the queued messages
+        self.assertEqual(Blob.objects.collect_garbage(grace_period=timedelta(0)), 0)
+
+        send_all()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[1].attachments, [("b.txt", "same", "text/plain")])
+
+        self.assertEqual(Blob.objects.collect_garbage(), 0)
+        self.assertEqual(Blob.objects.collect_garbage(grace_period=timedelta(0)), 1)
+        self.assertFalse(blob.file.storage.exists(blob.file.name))
+
+    def test_blob_used_during_collection_kept(self):
+        blob = Blob.objects.from_content(b"content")
+        Blob.objects.update(last_used=timezone.now() - timedelta(hours=2))
+        iterator = QuerySet.iterator
+
+        def touching(queryset, *args, **kwargs):
+            for found in iterator(queryset, *args, **kwargs):
+                # Stored again by an enqueue which didn't attach it yet
+                Blob.objects.from_content(b"content")
+                yield found
+
+        with mock.patch.object(QuerySet, "iterator", touching):
+            self.assertEqual(Blob.objects.collect_garbage(), 0)
+        self.assertTrue(Blob.objects.filter(pk=blob.pk).exists())
+        self.assertTrue(blob.file.storage.exists(blob.file.name))
+
+    @mock.patch("mailer.models.MAILER_CHUNK_SIZE", 100)
+    def test_file_content(self):
+        content = os.urandom(1000)
+        path = os.path.join(settings.MEDIA_ROOT, "upload.bin")
+        with open(path, "wb") as upload:
+            upload.write(content)
+
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com"],
+            attachments=[
+                ("stream.bin", io.BytesIO(content), None),
+                ("path.bin", pathlib.Path(path), None),
+            ],
+        )
+
+        # Both stored as the same blob
+        blob = Blob.objects.get()
+        self.assertEqual(blob.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(blob.size, 1000)
+        self.assertEqual(blob.read(), content)
+
+    @override_settings(MAILER_EMAIL_BACKEND="mailer.tests.FakeSMTPEmailBackend")
+    @mock.patch("mailer.engine.MAILER_STREAM_ATTACHMENTS_SIZE", 100)
+    @mock.patch("mailer.streaming.MAILER_CHUNK_SIZE", 100)
+    def test_streamed(self):
+        FakeSMTP.sent = []
+        content = os.urandom(1000)
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com"],
+            attachments=[
+                ("small.txt", b"attachment", "text/plain"),
+                ("large.bin", io.BytesIO(content), None),
+            ],
+        )
+
+        read = Attachment.read
+
+        def read_small(attachment):
+            self.assertLessEqual(attachment.size, 100)
+            return read(attachment)
+
+        with mock.patch.object(Attachment, "read", read_small):
+            send_all()
+
+        _, recipients, data = FakeSMTP.sent[0]
+        self.assertEqual(recipients, ["a@example.com"])
+        self.assertTrue(data.endswith(b"\r\n.\r\n"))
+        sent = email.message_from_bytes(data[: -len(b".\r\n")])
+        parts = sent.get_payload()
+        self.assertEqual(parts[1].get_payload(decode=True), b"attachment")
+        self.assertEqual(parts[2].get_filename(), "large.bin")
+        self.assertEqual(parts[2].get_payload(decode=True), content)
+        self.assertEqual(MessageLog.objects.count(), 1)
+
+    @mock.patch("mailer.engine.MAILER_STREAM_ATTACHMENTS_SIZE", 0)
+    def test_streamed_to_other_backends(self):
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com"],
+            attachments=[("file.txt", b"attachment", "text/plain")],
+        )
+
+        send_all()
+
+        part = mail.outbox[0].message().get_payload()[1]
+        self.assertEqual(part.get_filename(), "file.txt")
+        self.assertEqual(part.get_payload(decode=True), b"attachment")
+
+    def test_dot_stuffing(self):
+        smtp = FakeSMTP()
+        FakeSMTP.sent = []
+        streaming.sendmail(
+            smtp,
+            "sender@example.com",
+            ["a@example.com"],
+            [b"Subject: Dots\r\n\r\n", b".one\r\n", b".two\r\nth", b".ree"],
+        )
+
+        self.assertEqual(
+            FakeSMTP.sent[0][2],
+            b"Subject: Dots\r\n\r\n..one\r\n..two\r\nth.ree\r\n.\r\n",
+        )
+
+
+@override_settings(
+    EMAIL_BACKEND="mailer.backend.DbBackend",
+    MAILER_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+)
+class DbBackendTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        patcher = override_settings(MEDIA_ROOT=media_root)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def test_send_mass_mail(self):
+        datatuple = [
+            ("Subject", "Body", "sender@example.com", ["r%s@example.com" % i])
+            for i in range(50)
+        ]
+
+        # Savepoint, one insert and the release
+        with self.assertNumQueries(3):
+            self.assertEqual(mail.send_mass_mail(datatuple), 50)
+
+        self.assertEqual(Message.objects.ready().count(), 50)
+        send_all()
+        self.assertEqual(len(mail.outbox), 50)
+
+    def test_email_message(self):
+        email = mail.EmailMultiAlternatives(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["to1@example.com", "to2@example.com"],
+            bcc=["bcc@example.com"],
+            cc=["cc@example.com"],
+            reply_to=["reply@example.com"],
+            headers={"X-Custom": "value"},
+        )
+        email.attach_alternative("<p>Body</p>", "text/html")
+        email.attach_alternative("BEGIN:VCALENDAR", "text/calendar")
+        email.attach("file.txt", "attachment", "text/plain")
+        email.send()
+
+        self.assertEqual(
+            sorted(Message.objects.values_list("to_address", flat=True)),
+            ["bcc@example.com", "cc@example.com", "to1@example.com", "to2@example.com"],
+        )
+        self.assertEqual(Attachment.objects.count(), 4)
+
+        send_all()
+
+        # Sent once to all recipients, as they share the To header
+        self.assertEqual(len(mail.outbox), 1)
+        sent = mail.outbox[0]
+        self.assertEqual(
+            sorted(sent.to),
+            ["bcc@example.com", "cc@example.com", "to1@example.com", "to2@example.com"],
+        )
+        message = sent.message()
+        self.assertEqual(message["To"], "to1@example.com, to2@example.com")
+        self.assertEqual(message["Cc"], "cc@example.com")
+        self.assertEqual(message["Reply-To"], "reply@example.com")
+        self.assertEqual(message["X-Custom"], "value")
+        self.assertIsNone(message["Bcc"])
+        self.assertEqual(
+            sent.alternatives,
+            [("<p>Body</p>", "text/html"), ("BEGIN:VCALENDAR", "text/calendar")],
+        )
+        self.assertEqual(sent.attachments, [("file.txt", "attachment", "text/plain")])
+        self.assertEqual(MessageLog.objects.count(), 4)
+
+    def test_html_message(self):
+        email = mail.EmailMessage(
+            "Subject", "<p>Body</p>", "sender@example.com", ["r@example.com"]
+        )
+        email.content_subtype = "html"
+        email.send()
+
+        send_all()
+
+        sent = mail.outbox[0]
+        self.assertEqual(sent.body, "Body")
+        self.assertEqual(sent.alternatives, [("<p>Body</p>", "text/html")])
+        self.assertEqual(sent.message()["To"], "r@example.com")
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class SharedContentTest(TestCase):
+    def test_variables(self):
+        send_mail(
+            "Hello $name",
+            "Dear $name, it costs $$5.",
+            "sender@example.com",
+            [("a@example.com", {"name": "<Ann>"}), ("b@example.com", {"name": "Bob"})],
+            html_body="<p>Dear $name</p>",
+        )
+
+        # The bodies are stored once
+        self.assertEqual(MessageContent.objects.count(), 1)
+        self.assertEqual(
+            set(Message.objects.values_list("subject", "message_body", "html_body")),
+            {("", "", "")},
+        )
+
+        message = Message.objects.get(to_address="b@example.com")
+        self.assertEqual(message.get_subject(), "Hello Bob")
+        self.assertIn('"Hello Bob"', str(message))
+        queued = dict((m.to_address, m) for m in engine.prioritize())
+        self.assertEqual(queued["a@example.com"].subject, "Hello <Ann>")
+        self.assertEqual(queued["b@example.com"].message_body, "Dear Bob, it costs $5.")
+
+        send_all()
+
+        sent = dict((email.to[0], email) for email in mail.outbox)
+        self.assertEqual(sent["a@example.com"].subject, "Hello <Ann>")
+        self.assertEqual(sent["a@example.com"].body, "Dear <Ann>, it costs $5.")
+        self.assertEqual(
+            sent["a@example.com"].alternatives,
+            [("<p>Dear &lt;Ann&gt;</p>", "text/html")],
+        )
+        self.assertEqual(sent["b@example.com"].subject, "Hello Bob")
+        self.assertEqual(
+            MessageLog.objects.get(to_address="b@example.com").message_body,
+            "Dear Bob, it costs $5.",
+        )
+
+    def test_without_variables(self):
+        send_mail(
+            "Subject",
+            "It costs $$5 $name.",
+            "sender@example.com",
+            ["a@example.com", "b@example.com"],
+        )
+
+        send_all()
+
+        self.assertEqual(
+            [email.body for email in mail.outbox], ["It costs $$5 $name."] * 2
+        )
+
+    @mock.patch("mailer.engine.BATCH_SIZE", 2)
+    def test_fetched_once(self):
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["r%s@example.com" % i for i in range(5)],
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            send_all()
+
+        self.assertEqual(len(mail.outbox), 5)
+        fetched = [
+            query
+            for query in queries.captured_queries
+            if 'FROM "mailer_messagecontent"' in query["sql"]
+        ]
+        self.assertEqual(len(fetched), 1)
+
+    def test_garbage_collected(self):
+        send_mail(
+            "Subject", "Body", "sender@example.com", ["a@example.com", "b@example.com"]
+        )
+        self.assertEqual(
+            MessageContent.objects.collect_garbage(grace_period=timedelta(0)), 0
+        )
+
+        send_all()
+
+        call_command("purge_attachments", "--grace-period", "0")
+        self.assertEqual(MessageContent.objects.count(), 0)
+
+
+class ConnectionReuseTest(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        mail.outbox = []
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.CountingEmailBackend")
+    def test_one_connection_per_pass(self):
+        send_mail("Subject", "Body", "sender@example.com", ["a@example.com"])
+        send_mail("Subject", "Body", "sender@example.com", ["b@example.com"])
+        send_mail("Subject", "Body", "sender@example.com", ["c@example.com"])
+
+        send_all()
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.CountingEmailBackend")
+    def test_max_messages_per_connection(self):
+        for address in ["a@example.com", "b@example.com", "c@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+
+        with mock.patch("mailer.engine.CONNECTION_MAX_MESSAGES", 2):
+            send_all()
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(CountingEmailBackend.opened, 2)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.DisconnectingEmailBackend")
+    def test_reconnect_when_disconnected(self):
+        send_mail("Subject", "Body", "sender@example.com", ["a@example.com"])
+
+        send_all()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(CountingEmailBackend.opened, 2)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+@override_settings(
+    EMAIL_BACKEND="mailer.backend.DbBackend",
+    MAILER_EMAIL_BACKEND="mailer.tests.FakeSMTPEmailBackend",
+)
+class GroupingTest(TestCase):
+    def setUp(self):
+        FakeSMTP.sent = []
+
+    def test_shared_to_header(self):
+        mail.EmailMessage(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com", "refused@example.com", "b@example.org"],
+            bcc=["c@example.com"],
+        ).send()
+
+        send_all()
+
+        # One transaction per recipient domain
+        self.assertEqual(
+            sorted(recipients for _, recipients, _ in FakeSMTP.sent),
+            [
+                ["a@example.com", "refused@example.com", "c@example.com"],
+                ["b@example.org"],
+            ],
+        )
+        self.assertIn(
+            b"To: a@example.com, refused@example.com, b@example.org",
+            FakeSMTP.sent[0][2],
+        )
+        # Only the refused recipient is deferred
+        deferred = Message.objects.get()
+        self.assertEqual(deferred.to_address, "refused@example.com")
+        self.assertEqual(deferred.priority, PRIORITY_DEFERRED)
+        self.assertEqual(
+            MessageLog.objects.filter(result=RESULT_MAPPING["success"]).count(), 3
+        )
+        log = MessageLog.objects.get(result=RESULT_MAPPING["failure"])
+        self.assertIn("No such user", log.log_message)
+
+    def test_separate_messages(self):
+        for address in ["a@example.com", "b@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+
+        send_all()
+        self.assertEqual(len(FakeSMTP.sent), 2)
+
+        for address in ["a@example.com", "b@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+        with mock.patch("mailer.engine.GROUP_RECIPIENTS", True):
+            send_all()
+
+        _, recipients, data = FakeSMTP.sent[2]
+        self.assertEqual(recipients, ["a@example.com", "b@example.com"])
+        self.assertIn(b"To: undisclosed-recipients:;", data)
+
+    def test_max_recipients(self):
+        mail.EmailMessage(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["r%s@example.com" % i for i in range(5)],
+        ).send()
+
+        with mock.patch("mailer.engine.GROUP_MAX_RECIPIENTS", 2):
+            send_all()
+
+        self.assertEqual(
+            [len(recipients) for _, recipients, _ in FakeSMTP.sent], [2, 2, 1]
+        )
+        self.assertEqual(Message.objects.count(), 0)
+
+
+@override_settings(EMAIL_BACKEND="mailer.tests.RelayEmailBackend")
+class RelayTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(
+            "mailer.engine",
+            relays={},
+            RELAYS={"down": {"host": "down", "weight": 1000}, "up": {"host": "up"}},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failover(self):
+        for i in range(5):
+            send_mail("Subject", "Body", "sender@example.com", ["r%s@example.com" % i])
+        send_mail("Subject", "Body", "sender@example.com", ["refused@example.com"])
+        send_all()
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            set(sent.extra_headers["X-Relay"] for sent in mail.outbox), {"up"}
+        )
+        # Refused by the relay which was up, but not because of it
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(engine.relays["up"].failures, 0)
+        # Tried until its circuit opened
+        self.assertEqual(engine.relays["down"].failures, 3)
+        self.assertFalse(engine.relays["down"].available())
+
+    def test_circuit_half_open(self):
+        relay = Relay("down", {"host": "down"}, max_failures=2, retry_after=0)
+        relay.failed()
+        self.assertTrue(relay.available())
+        relay.failed()
+        self.assertEqual(relay.failures, 2)
+        # Let through again once retry_after passed
+        self.assertTrue(relay.available())
+        relay.succeeded()
+        self.assertIsNone(relay.closed_until)
+
+    def test_options(self):
+        relay = Relay("relay", {"host": "smtp", "port": 25, "user": "me", "weight": 2})
+        self.assertEqual(relay.options, {"host": "smtp", "port": 25, "username": "me"})
+        self.assertEqual(relay.weight, 2)
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class ClaimTest(TestCase):
+    def setUp(self):
+        for i in range(3):
+            send_mail("Subject", "Body", "sender@example.com", ["r%s@example.com" % i])
+
+    def test_claims_are_disjoint(self):
+        first = Message.objects.claim("worker-1", 2, 60)
+        second = Message.objects.claim("worker-2", 2, 60)
+
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(m.pk for m in first) & set(m.pk for m in second))
+        self.assertEqual(Message.objects.claim("worker-3", 2, 60), [])
+
+    def test_claim_retried_when_lost(self):
+        available = Message.objects.available
+        calls = []
+
+        def race(now=None):
+            calls.append(now)
+            if len(calls) == 2:
+                # Another worker claims the two messages selected first
+                first = Message.objects.order_by("id")[:2].values_list("id", flat=True)
+                Message.objects.filter(pk__in=list(first)).update(
+                    claimed_by="other", lease_until=now + timedelta(seconds=60)
+                )
+            return available(now)
+
+        with mock.patch.object(Message.objects, "available", side_effect=race):
+            claimed = Message.objects.claim("worker", 2, 60)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claimed[0].claimed_by, "worker")
+
+    def test_expired_lease_is_reclaimed(self):
+        Message.objects.claim("crashed", 3, 60)
+        self.assertEqual(Message.objects.claim("worker", 3, 60), [])
+
+        Message.objects.update(lease_until=timezone.now())
+        self.assertEqual(len(Message.objects.claim("worker", 3, 60)), 3)
+
+    def test_leased_messages_are_not_prioritized(self):
+        Message.objects.claim("worker", 2, 60)
+        self.assertEqual(len(list(engine.prioritize())), 1)
+
+    def test_worker_mode(self):
+        with mock.patch.object(mailer.lockfile.FileLock, "acquire") as lock:
+            send_all(worker=True)
+
+        lock.assert_not_called()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(Message.objects.count(), 0)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.SlowEmailBackend")
+    @mock.patch("mailer.engine.LEASE_SECONDS", 1)
+    def test_worker_mode_stops_before_lease_ends(self):
+        send_all(worker=True)
+
+        # The others are left for the next pass, without a log entry
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(MessageLog.objects.count(), 1)
+        self.assertEqual(Message.objects.filter(claimed_by="").count(), 2)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.TakenOverEmailBackend")
+    def test_worker_mode_keeps_taken_over(self):
+        send_all(worker=True)
+
+        # Removing them is up to the worker which holds them now
+        self.assertEqual(Message.objects.filter(claimed_by="other").count(), 3)
+
+    def test_renew(self):
+        claimed = Message.objects.claim("worker", 3, 60)
+        Message.objects.filter(pk=claimed[0].pk).update(claimed_by="other")
+
+        held = Message.objects.renew("worker", claimed, 600)
+        self.assertEqual(held, set(message.pk for message in claimed[1:]))
+        self.assertEqual(
+            Message.objects.filter(
+                lease_until__gt=timezone.now() + timedelta(seconds=300)
+            ).count(),
+            2,
+        )
+
+    def test_worker_mode_releases_deferred(self):
+        with self.settings(EMAIL_BACKEND="mailer.tests.FailingMailerEmailBackend"):
+            send_all(worker=True)
+
+        self.assertEqual(Message.objects.deferred().count(), 3)
+        self.assertEqual(Message.objects.filter(claimed_by="").count(), 3)
+        self.assertEqual(Message.objects.retry_deferred(), 3)
+        self.assertEqual(len(Message.objects.claim("worker", 3, 60)), 3)
+
+
+class ConcurrencyTest(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        mail.outbox = []
+        for i in range(6):
+            send_mail("Subject", "Body", "sender@example.com", ["r%s@example.com" % i])
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.CountingEmailBackend")
+    def test_concurrent_delivery(self):
+        send_all(concurrency=3)
+
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(MessageLog.objects.count(), 6)
+        self.assertLessEqual(CountingEmailBackend.opened, 3)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.FailingMailerEmailBackend")
+    def test_concurrent_failures_are_deferred(self):
+        send_all(concurrency=3)
+
+        self.assertEqual(Message.objects.deferred().count(), 6)
+        self.assertEqual(MessageLog.objects.count(), 6)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.CountingEmailBackend")
+    def test_concurrent_delivery_limit(self):
+        send_all(limit=4, concurrency=3)
+
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class FakeAsyncSMTP(object):
+    sent = []
+    opened = 0
+
+    def __init__(self, **kwargs):
+        self.is_connected = False
+
+    async def connect(self):
+        FakeAsyncSMTP.opened += 1
+        self.is_connected = True
+
+    async def sendmail(self, sender, recipients, message):
+        await asyncio.sleep(0)
+        refused = dict(
+            (recipient, aiosmtplib.SMTPResponse(550, "No such user"))
+            for recipient in recipients
+            if recipient.startswith("refused")
+        )
+        if len(refused) == len(recipients):
+            raise aiosmtplib.SMTPRecipientsRefused([])
+        FakeAsyncSMTP.sent.append((sender, recipients, message))
+        return refused, "OK"
+
+    async def quit(self):
+        self.is_connected = False
+
+
+@skipIf(aiosmtplib is None, "aiosmtplib is not installed")
+class AsyncEngineTest(TestCase):
+    def setUp(self):
+        FakeAsyncSMTP.sent = []
+        FakeAsyncSMTP.opened = 0
+        patcher = mock.patch("aiosmtplib.SMTP", FakeAsyncSMTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_send_all(self):
+        for i in range(5):
+            send_mail("Subject", "Body", "sender@example.com", ["r%s@example.com" % i])
+        send_mail("Subject", "Body", "sender@example.com", ["refused@example.com"])
+
+        async_engine.send_all(concurrency=2)
+
+        self.assertEqual(len(FakeAsyncSMTP.sent), 5)
+        self.assertEqual(FakeAsyncSMTP.opened, 2)
+        self.assertEqual(
+            sorted(recipients for _, recipients, _ in FakeAsyncSMTP.sent),
+            [["r%s@example.com" % i] for i in range(5)],
+        )
+        self.assertIn(b"Subject: Subject", FakeAsyncSMTP.sent[0][2])
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(MessageLog.objects.count(), 6)
+
+    @override_settings(EMAIL_BACKEND="mailer.backend.DbBackend")
+    def test_partly_refused(self):
+        mail.send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com", "refused@example.com"],
+        )
+
+        async_engine.send_all()
+
+        self.assertEqual(
+            [recipients for _, recipients, _ in FakeAsyncSMTP.sent],
+            [["a@example.com", "refused@example.com"]],
+        )
+        self.assertEqual(
+            Message.objects.deferred().get().to_address, "refused@example.com"
+        )
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class SuppressionTest(TestCase):
+    def setUp(self):
+        for address in ["nogo1@example.com", "nogo2@example.com"]:
+            DontSendEntry.objects.create(to_address=address, when_added=timezone.now())
+        for address in ["go@example.com", "nogo1@example.com", "nogo2@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+
+    def assertSuppressed(self):
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual([sent.to for sent in mail.outbox], [["go@example.com"]])
+        self.assertEqual(
+            MessageLog.objects.filter(result=RESULT_MAPPING["don't send"]).count(), 2
+        )
+
+    def test_set(self):
+        engine.send_all()
+        self.assertTrue(engine.dont_send.exact)
+        self.assertSuppressed()
+
+    def test_bloom_filter(self):
+        with mock.patch("mailer.suppression.BLOOM_THRESHOLD", 0):
+            engine.send_all()
+        self.assertIsInstance(engine.dont_send.addresses, BloomFilter)
+        self.assertSuppressed()
+
+    def test_reloaded_when_changed(self):
+        index = DontSendIndex()
+        index.refresh()
+        self.assertEqual(index.filter(["go@example.com"]), set())
+
+        DontSendEntry.objects.create(
+            to_address="go@example.com", when_added=timezone.now()
+        )
+        index.refresh()
+        # Not checked again within the refresh interval
+        self.assertEqual(index.filter(["go@example.com"]), set())
+        index.refresh(force=True)
+        self.assertEqual(index.filter(["go@example.com"]), {"go@example.com"})
+
+    def test_whitelist(self):
+        patterns = [re.compile(r"@example\.com$"), re.compile("^go@", re.I), "^x"]
+        combined = combine_patterns(patterns)
+        self.assertEqual(len(combined), 2)
+
+        with mock.patch("mailer.engine.WHITELIST", patterns), mock.patch(
+            "mailer.engine.WHITELIST_PATTERNS", combined
+        ):
+            self.assertTrue(engine.in_whitelist("a@example.com"))
+            self.assertTrue(engine.in_whitelist("GO@example.org"))
+            self.assertTrue(engine.in_whitelist("x@example.org"))
+            self.assertFalse(engine.in_whitelist("a@example.org"))
+
+    def test_whitelist_groups(self):
+        patterns = [
+            r"^(?P<u>a)@example\.com$",
+            r"^(?P<u>b)@example\.org$",
+            r"^(x)\1@",
+            "(?i)^go@",
+            "^y@",
+        ]
+        combined = combine_patterns(patterns)
+        self.assertEqual(len(combined), 5)
+
+        with mock.patch("mailer.engine.WHITELIST", patterns), mock.patch(
+            "mailer.engine.WHITELIST_PATTERNS", combined
+        ):
+            for address in ["a@example.com", "b@example.org", "xx@a", "GO@b", "y@c"]:
+                self.assertTrue(engine.in_whitelist(address))
+            self.assertFalse(engine.in_whitelist("x@a"))
+
+
+class PurgeMailLogTest(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for days, result in [
+            (1, "success"),
+            (40, "success"),
+            (40, "failure"),
+            (100, "failure"),
+        ]:
+            MessageLog.objects.create(
+                to_address="r@example.com",
+                from_address="sender@example.com",
+                subject="Subject",
+                message_body="Body",
+                when_added=now - timedelta(days=days),
+                when_attempted=now - timedelta(days=days),
+                priority=PRIORITY_MEDIUM,
+                result=RESULT_MAPPING[result],
+            )
+
+    def test_retention_per_result(self):
+        call_command("purge_mail_log", "--days", "60", "--success-days", "30")
+        self.assertEqual(
+            sorted(MessageLog.objects.values_list("result", flat=True)),
+            [RESULT_MAPPING["success"], RESULT_MAPPING["failure"]],
+        )
+
+    def test_archive(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "log.jsonl.gz")
+        call_command(
+            "purge_mail_log", "--days", "30", "--chunk-size", "1", "--archive", path
+        )
+        self.assertEqual(MessageLog.objects.count(), 1)
+        with gzip.open(path, "rt") as archive:
+            rows = [json.loads(line) for line in archive]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]["subject"], "Subject")
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+@mock.patch("mailer.fields.MAILER_COMPRESS_MIN_SIZE", 100)
+class CompressionTest(TestCase):
+    body = "<p>Newsletter</p>\n" * 100
+
+    def stored(self, model, field="html_body"):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT %s FROM %s" % (field, model._meta.db_table))
+            return [row[0] for row in cursor.fetchall()]
+
+    @mock.patch("mailer.fields.MAILER_COMPRESS_BODIES", "zlib")
+    def test_compressed(self):
+        for address in ["a@example.com", "b@example.com"]:
+            send_mail(
+                "Subject",
+                "Short body",
+                "sender@example.com",
+                [address],
+                html_body=self.body,
+            )
+
+        stored = self.stored(Message)
+        self.assertTrue(all(value.startswith("\x01Z") for value in stored))
+        self.assertLess(len(stored[0]), len(self.body) / 10)
+        # Too short to be worth it
+        self.assertEqual(self.stored(Message, "message_body"), ["Short body"] * 2)
+        self.assertEqual(Message.objects.filter(message_body="Short body").count(), 2)
+
+        send_all()
+
+        self.assertEqual(mail.outbox[0].alternatives, [(self.body, "text/html")])
+        self.assertTrue(self.stored(MessageLog)[0].startswith("\x01Z"))
+        self.assertEqual(MessageLog.objects.all()[0].html_body, self.body)
+
+    def test_compress_command(self):
+        for i in range(3):
+            send_mail(
+                "Subject",
+                "Body",
+                "sender@example.com",
+                ["a@example.com"],
+                html_body=self.body,
+            )
+        send_mail(
+            "Subject",
+            "Body",
+            "sender@example.com",
+            ["a@example.com", "b@example.com"],
+            html_body=self.body,
+        )
+        self.assertEqual(self.stored(Message), [self.body] * 3 + [""] * 2)
+
+        with self.assertRaises(CommandError):
+            call_command("compress_bodies")
+        with mock.patch("mailer.fields.MAILER_COMPRESS_BODIES", True):
+            call_command("compress_bodies", "--chunk-size", "2")
+            self.assertEqual(fields.compress_rows(Message.objects.all()), 0)
+
+        # Still readable once compression is off again
+        self.assertTrue(self.stored(Message)[2].startswith("\x01Z"))
+        self.assertTrue(self.stored(MessageContent)[0].startswith("\x01Z"))
+        self.assertEqual(
+            list(Message.objects.values_list("html_body", flat=True)[:3]),
+            [self.body] * 3,
+        )
+        self.assertEqual(MessageContent.objects.get().html_body, self.body)
+
+
+@skipIf(not hasattr(socket, "AF_UNIX"), "UNIX sockets are not available")
+class NotifyTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = os.path.join(directory, "send_mail.sockets")
+        patcher = mock.patch("mailer.notify.SOCKET_DIR", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_socket(self):
+        # Without a listener notifying does nothing
+        notify.notify()
+
+        listener = notify.listen()
+        self.addCleanup(listener.close)
+        self.assertFalse(listener.wait(0.01))
+        notify.notify()
+        notify.notify()
+        self.assertTrue(listener.wait(5))
+        # Both notifications were handled at once
+        self.assertFalse(listener.wait(0.01))
+
+    def test_several_loops(self):
+        first = notify.listen()
+        self.addCleanup(first.close)
+        second = notify.listen()
+        second_path = second.path
+
+        notify.notify()
+        self.assertTrue(first.wait(5))
+        self.assertTrue(second.wait(5))
+
+        # The one left keeps being notified
+        second.close()
+        self.assertFalse(os.path.exists(second_path))
+        notify.notify()
+        self.assertTrue(first.wait(5))
+
+    def test_stale_socket_removed(self):
+        listener = notify.listen()
+        path = listener.path
+        # As if the process died without closing it
+        listener.sock.close()
+
+        notify.notify()
+        self.assertFalse(os.path.exists(path))
+
+    def test_postgres_reconnect(self):
+        class Error(Exception):
+            pass
+
+        class FakeConnection(object):
+            def __init__(self, sock, error=None):
+                self.sock = sock
+                self.error = error
+                self.notifies = []
+                self.closed = False
+
+            def cursor(self):
+                return mock.MagicMock()
+
+            def fileno(self):
+                return self.sock.fileno()
+
+            def poll(self):
+                if self.error is not None:
+                    raise self.error
+                self.notifies.append("mailer_queue")
+
+            def close(self):
+                self.closed = True
+
+        readable, writer = socket.socketpair()
+        self.addCleanup(readable.close)
+        self.addCleanup(writer.close)
+        writer.send(b"1")
+        broken = FakeConnection(readable, Error("server closed the connection"))
+        healthy = FakeConnection(readable)
+        wrapper = mock.Mock()
+        wrapper.Database.Error = Error
+        wrapper.get_new_connection.side_effect = [broken, Error("down"), healthy]
+
+        with mock.patch("mailer.notify.connections", {"default": wrapper}):
+            listener = notify.PostgresListener("default")
+        # Lost, and the database can't be reached yet
+        self.assertFalse(listener.wait(0.01))
+        self.assertTrue(broken.closed)
+        self.assertIsNone(listener.connection)
+        # Listening again, maybe after missing notifications
+        self.assertTrue(listener.wait(0.01))
+        self.assertIs(listener.connection, healthy)
+        self.assertTrue(listener.wait(0.01))
+
+    def test_notified_on_commit(self):
+        with mock.patch("django.db.transaction.on_commit") as on_commit:
+            send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+        self.assertEqual(on_commit.call_count, 1)
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+@mock.patch("mailer.notify.ENABLED", False)
+class RunMailerTest(TestCase):
+    def setUp(self):
+        self.addCleanup(engine.stopping.clear)
+
+    def test_heartbeat(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "heartbeat.json")
+        send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+
+        call_command("runmailer", "--no-lock", "--max-passes", "1", "--heartbeat", path)
+        self.assertEqual(len(mail.outbox), 1)
+        with open(path) as heartbeat:
+            state = json.load(heartbeat)
+        self.assertEqual(state["passes"], 1)
+        self.assertEqual(state["sent"], 1)
+        self.assertIsNotNone(state["last_success"])
+
+    def test_already_locked(self):
+        send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+
+        with mock.patch.object(
+            mailer.lockfile.FileLock, "acquire", side_effect=lockfile.AlreadyLocked
+        ), mock.patch("mailer.notify.listen") as listen:
+            call_command("runmailer")
+        self.assertEqual(len(mail.outbox), 0)
+        # The running loop keeps its notifications
+        self.assertFalse(listen.called)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.StoppingEmailBackend")
+    def test_stop_after_message(self):
+        for address in ["a@example.com", "b@example.com", "c@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+
+        # The rest of the batch stays queued, without log entries
+        call_command("runmailer", "--no-lock")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(MessageLog.objects.count(), 1)
+
+    def test_heartbeat_unwritable(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "missing", "heartbeat.json")
+        send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+
+        # Stops after the pass as asked, not on the error
+        with mock.patch("mailer.management.commands.runmailer.logger") as logger:
+            call_command(
+                "runmailer", "--no-lock", "--max-passes", "1", "--heartbeat", path
+            )
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(logger.warning.called)
+
+    @override_settings(EMAIL_BACKEND="mailer.tests.StoppingEmailBackend")
+    def test_stop_after_batch(self):
+        for address in ["a@example.com", "b@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+
+        # Stopping while the first batch is sent leaves the second queued
+        with mock.patch("mailer.engine.BATCH_SIZE", 1):
+            call_command("runmailer", "--no-lock")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Message.objects.count(), 1)
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class ThrottleTest(TestCase):
+    def test_parse_rates(self):
+        self.assertEqual(parse_rates("10/s"), [(10, 1)])
+        self.assertEqual(parse_rates(["600/min", "5000/h"]), [(600, 60), (5000, 3600)])
+        self.assertEqual(parse_rates(None), [])
+
+    def test_buckets(self):
+        limiter = RateLimiter(
+            "100/s", {("gmail.com", "googlemail.com"): "20/s", "example.com": "1/h"}
+        )
+        self.assertEqual(
+            limiter.buckets("a@googlemail.com"),
+            [("*:1", 100, 1), ("gmail.com:1", 20, 1)],
+        )
+        self.assertEqual(
+            limiter.buckets("a@mail.example.com"),
+            [("*:1", 100, 1), ("example.com:3600", 1, 3600)],
+        )
+        self.assertEqual(limiter.buckets("a@example.org"), [("*:1", 100, 1)])
+
+    def test_domain_limit(self):
+        for address in ["a@example.com", "b@example.com", "c@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+        send_mail("Subject", "Body", "sender@example.com", ["d@example.org"])
+
+        with mock.patch(
+            "mailer.engine.throttle", RateLimiter(None, {"example.com": "2/h"})
+        ):
+            send_all()
+            self.assertEqual(len(mail.outbox), 3)
+            self.assertEqual(
+                list(Message.objects.values_list("to_address", flat=True)),
+                ["c@example.com"],
+            )
+            # Still no token left
+            send_all()
+            self.assertEqual(Message.objects.count(), 1)
+
+            TokenBucket.objects.update(updated=timezone.now() - timedelta(hours=1))
+            send_all()
+            self.assertEqual(Message.objects.count(), 0)
+
+    def test_exhausted_for_the_pass(self):
+        for address in ["a@example.com", "b@example.com", "c@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+        send_mail("Subject", "Body", "sender@example.com", ["d@example.org"])
+        limiter = RateLimiter(None, {"example.com": "1/h"})
+
+        acquire = TokenBucket.objects.acquire
+        with mock.patch("mailer.engine.throttle", limiter), mock.patch(
+            "mailer.engine.BATCH_SIZE", 1
+        ), mock.patch.object(
+            TokenBucket.objects, "acquire", side_effect=acquire
+        ) as acquired:
+            send_all()
+        self.assertEqual(len(mail.outbox), 2)
+        # Not looked at again once found exhausted
+        self.assertEqual(acquired.call_count, 2)
+        self.assertTrue(3500 < limiter.refill_delay() <= 3600)
+
+        limiter.reset()
+        self.assertIsNone(limiter.refill_delay())
+
+    def test_worker_mode(self):
+        for address in ["a@example.com", "b@example.com", "c@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+
+        with mock.patch("mailer.engine.throttle", RateLimiter("2/h")):
+            with mock.patch("mailer.engine.BATCH_SIZE", 1):
+                send_all(worker=True)
+        self.assertEqual(len(mail.outbox), 2)
+        # The rate limited message is given back to the queue after the pass
+        self.assertEqual(Message.objects.filter(claimed_by="").count(), 1)
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class MetricsTest(TestCase):
+    def test_prometheus(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "mailer.prom")
+        DontSendEntry.objects.create(
+            to_address="nogo@example.com", when_added=timezone.now()
+        )
+        for address in ["go@example.com", "nogo@example.com"]:
+            send_mail("Subject", "Body", "sender@example.com", [address])
+        send_mail("Subject", "Body", "sender@example.com", ["r@example.com"], "low")
+        Message.objects.filter(to_address="r@example.com").update(
+            priority=PRIORITY_DEFERRED
+        )
+
+        with mock.patch("mailer.metrics.recorder", PrometheusMetrics(path)):
+            send_all()
+        with open(path) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn("mailer_messages_sent_total 1", lines)
+        self.assertIn("mailer_messages_skipped_total 1", lines)
+        self.assertIn('mailer_queue_depth{priority="deferred"} 1', lines)
+        self.assertIn('mailer_queue_depth{priority="medium"} 0', lines)
+        self.assertIn("# TYPE mailer_smtp_send_seconds histogram", lines)
+        self.assertIn("mailer_smtp_send_seconds_count 1", lines)
+        self.assertIn('mailer_batch_fetch_seconds_bucket{le="+Inf"} 2', lines)
+
+    def test_prometheus_unwritable(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "missing", "mailer.prom")
+        send_mail("Subject", "Body", "sender@example.com", ["r@example.com"])
+
+        with mock.patch("mailer.metrics.recorder", PrometheusMetrics(path)):
+            send_all()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_pass_error_not_replaced(self):
+        recorder = PrometheusMetrics("unused.prom")
+        with mock.patch("mailer.metrics.recorder", recorder), mock.patch(
+            "mailer.engine.record_queue_depth", side_effect=DatabaseError
+        ), mock.patch("mailer.engine.send_messages_queued", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                send_all()
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        recorder = StatsdMetrics("127.0.0.1", server.getsockname()[1])
+
+        recorder.increment("messages_sent", 2)
+        recorder.gauge("queue_depth", 5, {"priority": "high"})
+        recorder.timing("smtp_send", 0.25)
+        self.assertEqual(server.recv(100), b"mailer.messages_sent:2|c")
+        self.assertEqual(server.recv(100), b"mailer.queue_depth.high:5|g")
+        self.assertEqual(server.recv(100), b"mailer.smtp_send:250.000|ms")
+
+
+class BloomFilterTest(TestCase):
+    def test_membership(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add("r%s@example.com" % i)
+        for i in range(1000):
+            self.assertIn("r%s@example.com" % i, bloom)
+        false_positives = sum("other%s@example.com" % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 50)
+
+
 class LockLockedTest(TestCase):
     def setUp(self):
         self.patcher_lock = mock.patch.object(
@@ -328,3 +1838,55 @@ class PrioritizeTest(TestCase):
         # Ensure deferred was not deleted
         self.assertEqual(Message.objects.count(), 1)
         self.assertEqual(Message.objects.deferred().count(), 1)
+
+    def test_prioritize_batches(self):
+        for i in range(5):
+            mailer.send_mail(
+                "Subject",
+                "Body",
+                "batch%s@example.com" % i,
+                ["r@example.com"],
+                priority=PRIORITY_LOW,
+            )
+
+        # Two queries per batch (messages and their attachments), plus the
+        # one finding the queue empty
+        with self.assertNumQueries(7):
+            batches = list(engine.prioritize_batches(batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(
+            [msg.from_address for batch in batches for msg in batch],
+            ["batch%s@example.com" % i for i in range(5)],
+        )
+
+    def test_prioritize_high_priority_between_batches(self):
+        for i in range(4):
+            mailer.send_mail(
+                "Subject",
+                "Body",
+                "low%s@example.com" % i,
+                ["r@example.com"],
+                priority=PRIORITY_LOW,
+            )
+
+        messages = engine.prioritize(batch_size=2)
+        self.assertEqual(next(messages).from_address, "low0@example.com")
+
+        mailer.send_mail(
+            "Subject",
+            "Body",
+            "high@example.com",
+            ["r@example.com"],
+            priority=PRIORITY_HIGH,
+        )
+
+        # The current batch is finished before the new mail is picked up
+        self.assertEqual(
+            [msg.from_address for msg in messages],
+            [
+                "low1@example.com",
+                "high@example.com",
+                "low2@example.com",
+                "low3@example.com",
+            ],
+        )
@@ -0,0 +1,147 @@
+"""
+Token bucket rate limits for sending, shared by all workers through the
+database.
+
+Limits are written like ``"10/s"``, ``"600/m"`` or ``"5000/h"``, or a list
+of those to apply several at once. ``MAILER_RATE_LIMIT`` applies to all mail
+and ``MAILER_DOMAIN_RATE_LIMITS`` to mail for a recipient domain (and its
+subdomains)::
+
+    MAILER_DOMAIN_RATE_LIMITS = {
+        "example.com": ["10/s", "5000/h"],
+        # Domains handled by the same mail servers can share their limits
+        ("gmail.com", "googlemail.com"): "20/s",
+    }
+"""
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from mailer.models import TokenBucket
+
+# Limit for all mail sent
+RATE_LIMIT = getattr(settings, "MAILER_RATE_LIMIT", None)
+
+# Limits per recipient domain
+DOMAIN_RATE_LIMITS = getattr(settings, "MAILER_DOMAIN_RATE_LIMITS", {})
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def parse_rates(rates):
+    """
+    Return the (count, seconds) of each limit in ``rates``.
+    """
+    if not rates:
+        return []
+    if isinstance(rates, str):
+        rates = [rates]
+    parsed = []
+    for rate in rates:
+        count, _, period = rate.partition("/")
+        parsed.append((int(count), PERIODS[period.strip().lower()[:1]]))
+    return parsed
+
+
+class RateLimiter(object):
+    def __init__(self, rate_limit=None, domain_rate_limits=None):
+        self.rates = parse_rates(rate_limit)
+        self.domains = {}
+        for domains, rates in (domain_rate_limits or {}).items():
+            if isinstance(domains, str):
+                domains = [domains]
+            group = (domains[0].lower(), parse_rates(rates))
+            for domain in domains:
+                self.domains[domain.lower()] = group
+        # Keys of the buckets found without tokens, with the time they have
+        # one again
+        self.exhausted = {}
+
+    def __bool__(self):
+        return bool(self.rates or self.domains)
+
+    __nonzero__ = __bool__
+
+    def buckets(self, address):
+        """
+        Return the (key, count, seconds) of the buckets mail to ``address``
+        takes a token from.
+        """
+        buckets = [("*:%s" % seconds, count, seconds) for count, seconds in self.rates]
+        domain = address.rpartition("@")[2].lower().rstrip(">")
+        while domain:
+            if domain in self.domains:
+                name, rates = self.domains[domain]
+                buckets.extend(
+                    ("%s:%s" % (name, seconds), count, seconds)
+                    for count, seconds in rates
+                )
+                break
+            domain = domain.partition(".")[2]
+        return buckets
+
+    def reset(self):
+        """
+        Forget the buckets found exhausted, at the start of a pass.
+        """
+        self.exhausted = {}
+
+    def refill_delay(self):
+        """
+        Seconds until the first exhausted bucket has a token again, or None.
+        """
+        if not self.exhausted:
+            return None
+        refill = min(self.exhausted.values())
+        return max((refill - timezone.now()).total_seconds(), 0)
+
+    def allow(self, messages):
+        """
+        Split ``messages`` in those which may be sent now, whose tokens are
+        taken, and those which have to wait. Mail for buckets found exhausted
+        earlier in the pass waits without looking at the database again.
+        """
+        messages = list(messages)
+        if not self:
+            return messages, []
+
+        now = timezone.now()
+        groups = OrderedDict()
+        for message in messages:
+            buckets = tuple(self.buckets(message.to_address))
+            groups.setdefault(buckets, []).append(message)
+        for buckets in list(groups):
+            if any(self.exhausted.get(key, now) > now for key, _, _ in buckets):
+                del groups[buckets]
+        limits = dict(
+            (key, (count, seconds))
+            for buckets in groups
+            for key, count, seconds in buckets
+        )
+
+        allowed = set()
+        if groups:
+            with transaction.atomic(using=TokenBucket.objects.db):
+                tokens = TokenBucket.objects.acquire(limits, now)
+                for buckets, group in groups.items():
+                    count = len(group)
+                    for key, _, _ in buckets:
+                        count = min(count, int(tokens[key]))
+                    for key, _, _ in buckets:
+                        tokens[key] -= count
+                    allowed.update(id(message) for message in group[:count])
+                TokenBucket.objects.store(tokens, now)
+            for key, left in tokens.items():
+                count, seconds = limits[key]
+                if left < 1:
+                    refill = (1 - left) * seconds / count
+                    self.exhausted[key] = now + timedelta(seconds=refill)
+                else:
+                    self.exhausted.pop(key, None)
+        return (
+            [message for message in messages if id(message) in allowed],
+            [message for message in messages if id(message) not in allowed],
+        )
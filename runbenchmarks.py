@@ -0,0 +1,246 @@
+"""
+Measure how fast mail is put on the queue and sent.
+
+Every run creates a fresh database, queues the given numbers of messages with
+``send_mail()`` (one at a time) and ``enqueue_messages()`` (in bulk), and
+sends them with ``send_all()`` to a local fake SMTP server::
+
+    python runbenchmarks.py --sizes 1000,100000 --latency 0.001
+    python runbenchmarks.py --database postgresql --db-name mailer_bench
+
+PostgreSQL connection settings other than the database name are taken from
+the usual PGHOST, PGPORT, PGUSER and PGPASSWORD environment variables.
+"""
+
+import argparse
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import django
+
+from django.conf import settings
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+DATABASES = {
+    "sqlite": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"},
+    "postgresql": {"ENGINE": "django.db.backends.postgresql"},
+}
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP to accept mail, waiting ``server.latency`` seconds
+    before accepting each message.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost fake SMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                time.sleep(self.server.latency)
+                with self.server.lock:
+                    self.server.received += 1
+                self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class FakeSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency):
+        socketserver.TCPServer.__init__(self, ("127.0.0.1", 0), FakeSMTPHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.received = 0
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def peak_memory():
+    """
+    Peak memory used by the process so far in megabytes, 0 where unknown.
+    """
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return usage / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def measure(name, size, function):
+    from django.db import connection
+
+    counter = QueryCounter()
+    start = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        function()
+    elapsed = time.perf_counter() - start
+    print(
+        "%-16s %9d %10.1f %12.0f %13.2f %11.1f"
+        % (
+            name,
+            size,
+            elapsed,
+            size / elapsed if elapsed else 0,
+            counter.count / size,
+            peak_memory(),
+        )
+    )
+
+
+def benchmark(size, server, concurrency):
+    import mailer
+
+    from mailer.engine import send_all
+    from mailer.models import Message
+
+    def enqueue_one_by_one():
+        for i in range(size):
+            mailer.send_mail(
+                "Subject", "Body", "sender@example.com", ["r%s@example.com" % i]
+            )
+
+    def enqueue_bulk():
+        mailer.enqueue_messages(
+            [
+                Message(
+                    to_address="r%s@example.com" % i,
+                    from_address="sender@example.com",
+                    subject="Subject",
+                    message_body="Body",
+                )
+                for i in range(size)
+            ]
+        )
+
+    def drain():
+        server.received = 0
+        send_all(concurrency=concurrency)
+        assert server.received == size, "%s of %s sent" % (server.received, size)
+
+    measure("send_mail", size, enqueue_one_by_one)
+    Message.objects.all().delete()
+    measure("enqueue_messages", size, enqueue_bulk)
+    measure("send_all", size, drain)
+
+
+def runbenchmarks():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        default="1000",
+        help="Comma separated numbers of messages to queue (default 1000).",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Seconds the fake SMTP server takes to accept a message.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of threads sending mail.",
+    )
+    parser.add_argument(
+        "--log-detail",
+        choices=["full", "hash", "headers"],
+        default="full",
+        help="MAILER_LOG_DETAIL to send with (default full, as installed).",
+    )
+    parser.add_argument(
+        "--database",
+        choices=sorted(DATABASES),
+        default="sqlite",
+    )
+    parser.add_argument(
+        "--db-name",
+        default="mailer_benchmarks",
+        help="Name of the PostgreSQL database, which is created and dropped.",
+    )
+    args = parser.parse_args()
+
+    server = FakeSMTPServer(args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    database = dict(DATABASES[args.database])
+    if args.database == "postgresql":
+        database.update(
+            NAME=os.environ.get("PGDATABASE", "postgres"),
+            HOST=os.environ.get("PGHOST", ""),
+            PORT=os.environ.get("PGPORT", ""),
+            USER=os.environ.get("PGUSER", ""),
+            PASSWORD=os.environ.get("PGPASSWORD", ""),
+            TEST={"NAME": args.db_name},
+        )
+    settings.configure(
+        INSTALLED_APPS=[
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "mailer",
+        ],
+        DATABASES={"default": database},
+        SECRET_KEY="notasecret",
+        EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+        EMAIL_HOST="127.0.0.1",
+        EMAIL_PORT=server.server_address[1],
+        MAILER_NOTIFY=False,
+        MAILER_LOG_DETAIL=args.log_detail,
+    )
+    django.setup()
+
+    from django.db import connection
+
+    print(
+        "%s, SMTP latency %ss, log detail %s"
+        % (args.database, args.latency, args.log_detail)
+    )
+    print(
+        "%-16s %9s %10s %12s %13s %11s"
+        % ("", "messages", "seconds", "messages/s", "queries/msg", "peak MB")
+    )
+    for size in [int(size) for size in args.sizes.split(",")]:
+        name = connection.creation.create_test_db(verbosity=0, keepdb=False)
+        try:
+            benchmark(size, server, args.concurrency)
+        finally:
+            connection.creation.destroy_test_db(name, verbosity=0)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    runbenchmarks()
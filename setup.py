@@ -36,5 +36,9 @@ setup(
         "lockfile>=0.8",
         "six",
     ],
+    extras_require={
+        "async": ["aiosmtplib>=2.0"],
+        "zstd": ["zstandard>=0.11"],
+    },
     python_requires=">=3.5",
 )